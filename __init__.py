@@ -14,12 +14,14 @@ from . import location
 def register():
     Pool.register(
         package.ProductPack,
+        period.Cron,
         product.Template,
         product.Product,
         period.Period,
         period.PeriodCache,
         period.PeriodCachePackage,
         move.Move,
+        move.MovePackageDelta,
         shipment.ShipmentIn,
         shipment.ShipmentOut,
         shipment.ShipmentOutReturn,
@@ -30,7 +32,11 @@ def register():
     Pool.register(
         lot.Lot,
         move.MoveLot,
+        move.MovePackageDeltaLot,
         inventory.LotInventoryLine,
+        shipment.ShipmentInLot,
+        period.PeriodLot,
         period.PeriodCacheLot,
+        period.PeriodCacheLotPackage,
         depends=['stock_lot'],
         module='stock_number_of_packages', type_='model')
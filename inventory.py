@@ -1,7 +1,15 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import csv
+import io
+from collections import defaultdict
+from itertools import islice
+from trytond.exceptions import UserError
+from trytond.i18n import gettext
 from trytond.model import fields
 from trytond.pool import Pool, PoolMeta
+from trytond.pyson import Eval
+from trytond.rpc import RPC
 from trytond.transaction import Transaction
 
 from .move import StockPackagedMixin, LotPackagedMixin
@@ -11,6 +19,25 @@ __all__ = ['Inventory', 'InventoryLine']
 
 class Inventory(metaclass=PoolMeta):
     __name__ = 'stock.inventory'
+    cycle_count = fields.Boolean('Cycle Count',
+        states={
+            'readonly': Eval('state') != 'draft',
+            },
+        depends=['state'],
+        help='Only the scanned products are completed and the number of '
+        'packages is expected lazily for the scanned keys.')
+
+    @classmethod
+    def __setup__(cls):
+        super(Inventory, cls).__setup__()
+        cls.__rpc__.update({
+                'add_scanned_packages': RPC(readonly=False, instantiate=0),
+                'import_package_counts': RPC(readonly=False, instantiate=0),
+                })
+
+    @staticmethod
+    def default_cycle_count():
+        return False
 
     @classmethod
     def grouping(cls):
@@ -18,6 +45,13 @@ class Inventory(metaclass=PoolMeta):
 
     @classmethod
     def confirm(cls, inventories):
+        pool = Pool()
+        Line = pool.get('stock.inventory.line')
+        # The lines are checked in a single pass which reads their products,
+        # packagings and lots once for the moves, so the moves are not
+        # checked one by one
+        lines = Line.browse([l.id for i in inventories for l in i.lines])
+        Line.check_packages(lines, [l.quantity for l in lines])
         with Transaction().set_context(
                 no_check_quantity_number_of_packages=True):
             super(Inventory, cls).confirm(inventories)
@@ -29,14 +63,20 @@ class Inventory(metaclass=PoolMeta):
         Line = pool.get('stock.inventory.line')
         Product = pool.get('product.product')
 
-        super(Inventory, cls).complete_lines(inventories, fill)
+        super(Inventory, cls).complete_lines(
+            [i for i in inventories if not i.cycle_count], fill)
+        # Cycle counts only fill the lines of the scanned products
+        super(Inventory, cls).complete_lines(
+            [i for i in inventories if i.cycle_count], False)
 
         grouping = cls.grouping()
         to_create = []
         for inventory in inventories:
             # Compute product number of packages
             product_ids = None
-            if getattr(inventory, 'product_category', None):
+            if inventory.cycle_count:
+                product_ids = list({l.product.id for l in inventory.lines})
+            elif getattr(inventory, 'product_category', None):
                 categories = Category.search([
                         ('parent', 'child_of',
                             [inventory.product_category.id]),
@@ -103,7 +143,11 @@ class Inventory(metaclass=PoolMeta):
                 for i, fname in enumerate(grouping, 1):
                     values[fname] = key[i]
                 values['expected_number_of_packages'] = int(number_of_packages)
-                if getattr(inventory, 'init_quantity_zero', False):
+                if inventory.cycle_count:
+                    # Not scanned so nothing was found
+                    values['number_of_packages'] = 0
+                    values['quantity'] = 0.
+                elif getattr(inventory, 'init_quantity_zero', False):
                     values['number_of_packages'] = 0
                 else:
                     values['number_of_packages'] = max(
@@ -112,6 +156,200 @@ class Inventory(metaclass=PoolMeta):
         if to_create:
             Line.create(to_create)
 
+    @classmethod
+    def check_add_packages(cls, inventory):
+        if inventory.state != 'draft':
+            raise UserError(gettext(
+                    'stock_number_of_packages.add_packages_not_draft',
+                    inventory=inventory.rec_name))
+
+    @classmethod
+    def add_scanned_packages(cls, inventory, scans, replace=False):
+        '''
+        Add the scanned packages to the inventory.
+
+        scans is a list of (product, lot, package, number_of_packages) tuples
+        of ids. The lines with the same key are incremented, or set if
+        replace is True, and the expected number of packages is computed at
+        once for the new keys only.
+        '''
+        pool = Pool()
+        Line = pool.get('stock.inventory.line')
+        Package = pool.get('product.pack')
+
+        cls.check_add_packages(inventory)
+        grouping = cls.grouping()
+        to_add = defaultdict(int)
+        for product_id, lot_id, package_id, number_of_packages in scans:
+            values = {
+                'product': product_id,
+                'lot': lot_id,
+                'package': package_id,
+                }
+            key = tuple(values[f] for f in grouping)
+            to_add[key] += number_of_packages
+        if not to_add:
+            return
+
+        product_ids = list({k[grouping.index('product')] for k in to_add})
+        lines = {l.unique_key: l for l in Line.search([
+                    ('inventory', '=', inventory.id),
+                    ('product', 'in', product_ids),
+                    ])}
+
+        numbers = {}
+        for key, number_of_packages in to_add.items():
+            line = lines.get(key)
+            if line and not replace:
+                number_of_packages += line.number_of_packages or 0
+            numbers[key] = number_of_packages
+        keys = list(numbers)
+        key_values = [dict(zip(grouping, k)) for k in keys]
+        quantities = dict(zip(keys, Package.compute_quantities(
+                    [v['product'] for v in key_values],
+                    [v.get('lot') for v in key_values],
+                    [v['package'] for v in key_values],
+                    [numbers[k] for k in keys])))
+
+        to_create, to_write = [], []
+        for key, number_of_packages in numbers.items():
+            line = lines.get(key)
+            if line:
+                to_write.extend(([line], {
+                            'number_of_packages': number_of_packages,
+                            'quantity': quantities[key],
+                            }))
+            else:
+                values = {
+                    'inventory': inventory.id,
+                    'number_of_packages': number_of_packages,
+                    'quantity': quantities[key],
+                    }
+                values.update(zip(grouping, key))
+                to_create.append(values)
+        if to_write:
+            Line.write(*to_write)
+        if to_create:
+            Line.create(to_create)
+
+    @classmethod
+    def import_package_counts(cls, inventory, data):
+        '''
+        Import the package counts of a CSV file into the inventory.
+
+        Each row contains the product code, the lot number, the package name
+        and the number of packages. The lot and the package may be empty,
+        then the default package of the product is used.
+        data is a string, bytes, a file or an iterator of lines. Only files
+        and iterators are read as a stream, the rows are processed by
+        batches. The counts of the rows with the same key are summed and
+        replace the count of the existing lines, so importing the same file
+        twice gives the same counts.
+        '''
+        pool = Pool()
+        Product = pool.get('product.product')
+        Package = pool.get('product.pack')
+        Lot = pool.get('stock.lot') if 'lot' in cls.grouping() else None
+
+        cls.check_add_packages(inventory)
+        if isinstance(data, str):
+            data = io.StringIO(data)
+        elif isinstance(data, (bytes, bytearray, memoryview)):
+            data = io.TextIOWrapper(io.BytesIO(data), encoding='utf-8')
+        elif isinstance(data, io.BufferedIOBase):
+            data = io.TextIOWrapper(data, encoding='utf-8')
+        reader = enumerate(csv.reader(data), 1)
+        grouping = cls.grouping()
+        # The keys already imported are incremented by the next batches
+        imported = set()
+
+        size = Transaction().database.IN_MAX
+        while True:
+            batch = list(islice(reader, size))
+            if not batch:
+                break
+            rows = []
+            for i, row in batch:
+                if not any(r.strip() for r in row):
+                    continue
+                if len(row) != 4:
+                    raise UserError(gettext(
+                            'stock_number_of_packages.import_invalid_row',
+                            row=i))
+                rows.append((i, row))
+            if not rows:
+                continue
+            codes = {r[0].strip() for _, r in rows}
+            products = {p.code: p for p in Product.search([
+                        ('code', 'in', list(codes)),
+                        ])}
+            templates = list({p.template.id for p in products.values()})
+            packages = {(p.product.id, p.name): p for p in Package.search([
+                        ('product', 'in', templates),
+                        ('name', 'in', list({r[2].strip()
+                                    for _, r in rows if r[2].strip()})),
+                        ])}
+            lots = {}
+            if Lot:
+                lots = {(l.product.id, l.number): l for l in Lot.search([
+                            ('product', 'in',
+                                [p.id for p in products.values()]),
+                            ('number', 'in', list({r[1].strip()
+                                        for _, r in rows if r[1].strip()})),
+                            ])}
+
+            scans = []
+            for i, (code, lot_number, package_name, number_of_packages) in (
+                    rows):
+                code = code.strip()
+                lot_number = lot_number.strip()
+                package_name = package_name.strip()
+                product = products.get(code)
+                if not product:
+                    raise UserError(gettext(
+                            'stock_number_of_packages.import_unknown_product',
+                            row=i, product=code))
+                lot = None
+                if lot_number and Lot:
+                    lot = lots.get((product.id, lot_number))
+                    if not lot:
+                        raise UserError(gettext(
+                                'stock_number_of_packages.import_unknown_lot',
+                                row=i, lot=lot_number))
+                if package_name:
+                    package = packages.get(
+                        (product.template.id, package_name))
+                    if not package:
+                        raise UserError(gettext('stock_number_of_packages'
+                                '.import_unknown_package',
+                                row=i, package=package_name))
+                elif lot and lot.package:
+                    package = lot.package
+                else:
+                    package = product.default_package
+                try:
+                    number_of_packages = int(number_of_packages)
+                except ValueError:
+                    raise UserError(gettext(
+                            'stock_number_of_packages.import_invalid_number',
+                            row=i, number=number_of_packages))
+                scans.append((product.id, lot.id if lot else None,
+                        package.id if package else None, number_of_packages))
+            to_replace, to_add, keys = [], [], set()
+            for scan in scans:
+                values = dict(zip(('product', 'lot', 'package'), scan))
+                key = tuple(values[f] for f in grouping)
+                if key in imported:
+                    to_add.append(scan)
+                else:
+                    to_replace.append(scan)
+                keys.add(key)
+            imported.update(keys)
+            if to_replace:
+                cls.add_scanned_packages(inventory, to_replace, replace=True)
+            if to_add:
+                cls.add_scanned_packages(inventory, to_add)
+
 
 class LotInventoryLine(LotPackagedMixin, metaclass=PoolMeta):
     __name__ = 'stock.inventory.line'
@@ -184,20 +422,22 @@ class InventoryLine(StockPackagedMixin, metaclass=PoolMeta):
     @classmethod
     def validate(cls, records):
         super(InventoryLine, cls).validate(records)
-        for line in records:
-            if line.inventory.state == 'done':
-                line.check_package(line.quantity)
+        lines = [l for l in records if l.inventory.state == 'done']
+        cls.check_packages(lines, [l.quantity for l in lines])
 
     @classmethod
     def create(cls, vlist):
+        to_compute = defaultdict(list)
         for values in vlist:
             if 'expected_number_of_packages' not in values:
-                values['expected_number_of_packages'] = int(
-                    cls._compute_expected_number_of_packages(
-                        values.get('inventory'),
-                        values.get('product'),
-                        values.get('lot'),
-                        values.get('package')))
+                to_compute[values.get('inventory')].append(values)
+        for inventory, inventory_vlist in to_compute.items():
+            keys = [(v.get('product'), v.get('lot'), v.get('package'))
+                for v in inventory_vlist]
+            expected = cls.compute_expected_number_of_packages(
+                inventory, keys)
+            for values, key in zip(inventory_vlist, keys):
+                values['expected_number_of_packages'] = expected[key]
 
         return super(InventoryLine, cls).create(vlist)
 
@@ -205,29 +445,43 @@ class InventoryLine(StockPackagedMixin, metaclass=PoolMeta):
     def _compute_expected_number_of_packages(inventory, product_id, lot_id,
             package_id):
         pool = Pool()
+        Line = pool.get('stock.inventory.line')
+        key = (product_id, lot_id, package_id)
+        return Line.compute_expected_number_of_packages(inventory, [key])[key]
+
+    @classmethod
+    def compute_expected_number_of_packages(cls, inventory, keys):
+        '''
+        Return a dictionary with the expected number of packages of the
+        inventory for each (product, lot, package) key computed with a
+        single query.
+        '''
+        pool = Pool()
         Inventory = pool.get('stock.inventory')
         Product = pool.get('product.product')
 
-        if not isinstance(inventory, Inventory):
+        if inventory is not None and not isinstance(inventory, Inventory):
             inventory = Inventory(inventory)
 
         if not inventory or not inventory.location:
-            return 0
+            return {k: 0 for k in keys}
 
+        location_id = inventory.location.id
         if 'lot' in Inventory.grouping():
             grouping = ('product', 'lot', 'package')
-            key = (inventory.location.id, product_id, lot_id, package_id)
+            pbl_key = lambda k: (location_id,) + tuple(k)
         else:
             grouping = ('product', 'package')
-            key = (inventory.location.id, product_id, package_id)
+            pbl_key = lambda k: (location_id, k[0], k[2])
 
+        product_ids = list({k[0] for k in keys if k[0] is not None})
+        if not product_ids:
+            return {k: 0 for k in keys}
         with Transaction().set_context(
                 stock_date_end=inventory.date,
                 number_of_packages=True):
             pbl = Product.products_by_location(
-                [inventory.location.id], grouping_filter=([product_id],),
+                [location_id], grouping_filter=(product_ids,),
                 grouping=grouping)
 
-        if key in pbl:
-            return int(pbl.pop(key) or 0)
-        return 0
+        return {k: int(pbl.get(pbl_key(k)) or 0) for k in keys}
@@ -27,11 +27,14 @@ class Lot(StockMixin, metaclass=PoolMeta):
     __name__ = 'stock.lot'
 
     package = fields.Many2One('product.pack', 'Packaging', domain=[
-            ('product.products', 'in', [Eval('product')]),
+            ('id', 'in', Eval('product_packagings', [])),
             ],
         states={
             'readonly': Eval('id', -1) > 0,
-        }, depends=['product', 'id'])
+        }, depends=['product', 'product_packagings', 'id'])
+    product_packagings = fields.Function(fields.Many2Many('product.pack',
+            None, None, 'Product Packagings'),
+        'get_product_packagings')
     initial_number_of_packages = fields.Integer('Initial Number of packages',
         domain=[
             ['OR',
@@ -107,15 +110,33 @@ class Lot(StockMixin, metaclass=PoolMeta):
     def search_package_required(cls, name, clause):
         return [('product.template.package_required', ) + tuple(clause[1:])]
 
-    @fields.depends('product', 'package', methods=['on_change_package'])
+    @fields.depends('product')
+    def on_change_with_product_packagings(self, name=None):
+        pool = Pool()
+        Package = pool.get('product.pack')
+        if not self.product:
+            return []
+        return Package.get_product_packagings([self.product])[self.product.id]
+
+    @classmethod
+    def get_product_packagings(cls, records, name):
+        pool = Pool()
+        Package = pool.get('product.pack')
+        packagings = Package.get_product_packagings(
+            [r.product for r in records if r.product])
+        return {r.id: packagings[r.product.id] if r.product else []
+            for r in records}
+
+    @fields.depends('product', 'package', methods=['on_change_package',
+            'on_change_with_product_packagings'])
     def on_change_product(self):
         try:
             super(Lot, self).on_change_product()
         except AttributeError:
             pass
         if (not self.product or not self.product.default_package
-                or (self.package
-                    and self.package.product == self.product.template)):
+                or (self.package and self.package.id in
+                    self.on_change_with_product_packagings())):
             return
         self.package = self.product.default_package
         self.on_change_package()
@@ -123,17 +144,24 @@ class Lot(StockMixin, metaclass=PoolMeta):
     @fields.depends('package')
     def on_change_package(self):
         if self.package:
-            if self.package.qty:
-                self.package_qty = self.package.qty
-            if self.package.weight:
-                self.package_weight = self._round_weight(self.package.weight)
-            if self.package.pallet_weight:
-                self.pallet_weight = self._round_weight(
-                    self.package.pallet_weight)
-            n_packages = ((self.package.layers or 0)
-                * (self.package.packages_layer or 0))
-            if n_packages:
-                self.initial_number_of_packages = n_packages
+            for fname, value in self.get_package_values(
+                    self.package).items():
+                setattr(self, fname, value)
+
+    @classmethod
+    def get_package_values(cls, package):
+        "Return the default values of a lot for the package"
+        values = {}
+        if package.qty:
+            values['package_qty'] = package.qty
+        if package.weight:
+            values['package_weight'] = cls._round_weight(package.weight)
+        if package.pallet_weight:
+            values['pallet_weight'] = cls._round_weight(package.pallet_weight)
+        n_packages = (package.layers or 0) * (package.packages_layer or 0)
+        if n_packages:
+            values['initial_number_of_packages'] = n_packages
+        return values
 
     @fields.depends('product')
     def on_change_with_product_uom(self, name=None):
@@ -179,18 +207,16 @@ class Lot(StockMixin, metaclass=PoolMeta):
     @fields.depends('product', 'initial_number_of_packages', 'package_qty')
     def on_change_with_total_qty(self, name=None):
         pool = Pool()
-        Uom = pool.get('product.uom')
+        Package = pool.get('product.pack')
         if any(f is None for f in [
                     self.initial_number_of_packages,
                     self.package_qty]):
             return
-
-        if self.product:
-            default_uom = self.product.default_uom
-        else:
-            default_uom = Uom()
-        return default_uom.round(self.initial_number_of_packages *
-            self.package_qty)
+        if not self.package_qty:
+            return 0.0
+        total_qty, = Package.compute_quantities([self.product], [self],
+            [None], [self.initial_number_of_packages])
+        return total_qty
 
     @staticmethod
     def default_weight_unit_digits():
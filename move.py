@@ -1,14 +1,20 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
-from trytond.model import fields
+import datetime
+from collections import defaultdict
+from sql import For
+from trytond.config import config
+from trytond.model import ModelSQL, fields
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Bool, Eval, In
+from trytond.tools import grouped_slice, reduce_ids
 from trytond.transaction import Transaction
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
 from trytond.modules.stock_number_of_packages.package import PackagedMixin
 
-__all__ = ['StockPackagedMixin', 'StockMixin', 'Move', 'MoveLot']
+__all__ = ['StockPackagedMixin', 'StockMixin', 'Move', 'MoveLot',
+    'MovePackageDelta', 'MovePackageDeltaLot']
 
 
 class LotPackagedMixin(object):
@@ -37,12 +43,14 @@ class LotPackagedMixin(object):
 
 class StockPackagedMixin(PackagedMixin):
 
-    def check_package(self, quantity):
-        if self.number_of_packages and self.number_of_packages < 0:
-            raise UserError(gettext(
-                'stock_number_of_packages.number_of_packages_positive',
-                    line=self.rec_name))
-        super(StockPackagedMixin, self).check_package(quantity)
+    @classmethod
+    def check_packages(cls, records, quantities):
+        for record in records:
+            if record.number_of_packages and record.number_of_packages < 0:
+                raise UserError(gettext(
+                    'stock_number_of_packages.number_of_packages_positive',
+                        line=record.rec_name))
+        super(StockPackagedMixin, cls).check_packages(records, quantities)
 
 
 class StockMixin(object):
@@ -97,6 +105,49 @@ class Move(StockPackagedMixin, metaclass=PoolMeta):
         cls._deny_modify_assigned |= set(['number_of_packages',
                 'number_of_packages'])
 
+    @classmethod
+    def create(cls, vlist):
+        PackageDelta = Pool().get('stock.move.package_delta')
+        moves = super(Move, cls).create(vlist)
+        PackageDelta.record(moves, {})
+        Pool().get('product.product').clear_number_of_packages_cache(
+            done=any(m.state == 'done' for m in moves))
+        return moves
+
+    @classmethod
+    def write(cls, *args):
+        PackageDelta = Pool().get('stock.move.package_delta')
+        delta_fields = set(PackageDelta.move_fields())
+        # The fields which change the quantities shared between processes
+        quantity_fields = delta_fields | {'quantity', 'internal_quantity',
+            'uom', 'effective_date', 'planned_date', 'company'}
+
+        actions = iter(args)
+        done = False
+        to_record = set()
+        for moves, values in zip(actions, actions):
+            moves_done = (values.get('state') == 'done'
+                or any(m.state == 'done' for m in moves))
+            done |= moves_done and bool(quantity_fields & set(values))
+            if moves_done and delta_fields & set(values):
+                to_record.update(m.id for m in moves)
+        to_record = list(to_record)
+        before = PackageDelta.get_numbers_of_packages(cls.browse(to_record))
+        super(Move, cls).write(*args)
+        PackageDelta.record(cls.browse(to_record), before)
+        Pool().get('product.product').clear_number_of_packages_cache(
+            done=done)
+
+    @classmethod
+    def delete(cls, moves):
+        PackageDelta = Pool().get('stock.move.package_delta')
+        done = any(m.state == 'done' for m in moves)
+        before = PackageDelta.get_numbers_of_packages(moves)
+        super(Move, cls).delete(moves)
+        PackageDelta.record([], before)
+        Pool().get('product.product').clear_number_of_packages_cache(
+            done=done)
+
     @classmethod
     def validate(cls, records):
         super(Move, cls).validate(records)
@@ -104,15 +155,19 @@ class Move(StockPackagedMixin, metaclass=PoolMeta):
         InventoryLine = pool.get('stock.inventory.line')
         ShipmentOut = pool.get('stock.shipment.out')
 
-        for move in records:
-            check = (isinstance(move.shipment, ShipmentOut) or
-                isinstance(move.origin, InventoryLine))
-            if move.state in ('assigned', 'done'):
-                with Transaction().set_context(
-                        no_check_quantity_number_of_packages=check):
-                    move.check_package(
-                        move._get_internal_quantity(move.quantity, move.uom,
-                            move.product))
+        to_check = [m for m in records
+            if m.state in ('assigned', 'done')
+            and not isinstance(m.shipment, ShipmentOut)
+            and not isinstance(m.origin, InventoryLine)]
+        if not to_check:
+            return
+        # Only the moves of outgoing shipments and inventories skip the
+        # check, the others are checked in a single pass
+        with Transaction().set_context(
+                no_check_quantity_number_of_packages=False):
+            cls.check_packages(to_check, [
+                    m._get_internal_quantity(m.quantity, m.uom, m.product)
+                    for m in to_check])
 
     @classmethod
     def compute_quantities_query(cls, location_ids, with_childs=False,
@@ -126,3 +181,249 @@ class Move(StockPackagedMixin, metaclass=PoolMeta):
         return super(Move, cls).compute_quantities_query(
             location_ids, with_childs=with_childs, grouping=grouping,
             grouping_filter=grouping_filter, quantity_field=quantity_field)
+
+    @classmethod
+    def assign_try_packages(cls, moves, with_childs=True, order='fifo'):
+        '''
+        Try to assign the moves by whole packages.
+
+        The packages are picked from the lots and packages available in the
+        locations, ordered by lot creation (fifo) or by location (location),
+        computed with a single query for all the moves.
+        The rows of the products of the moves are locked without waiting, so
+        a concurrent assignment of the same products makes the transaction
+        fail and be retried with a new snapshot while the other moves can
+        still be written.
+        Return True if all the moves are assigned.
+        '''
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Location = pool.get('stock.location')
+        Package = pool.get('product.pack')
+        Product = pool.get('product.product')
+        Uom = pool.get('product.uom')
+        transaction = Transaction()
+
+        moves = [m for m in moves if m.state == 'draft']
+        if not moves:
+            return True
+        if hasattr(cls, 'lot'):
+            Lot = pool.get('stock.lot')
+            grouping = ('product', 'lot', 'package')
+        else:
+            Lot = None
+            grouping = ('product', 'package')
+
+        product_ids = list({m.product.id for m in moves})
+        if transaction.database.has_select_for():
+            product = Product.__table__()
+            cursor = transaction.connection.cursor()
+            for sub_ids in grouped_slice(product_ids):
+                cursor.execute(*product.select(product.id,
+                        where=reduce_ids(product.id, sub_ids),
+                        for_=For('UPDATE', nowait=True)))
+
+        from_locations = list({m.from_location for m in moves})
+        if with_childs:
+            locations = Location.search([
+                    ('parent', 'child_of', [l.id for l in from_locations]),
+                    ], order=[('left', 'ASC')])
+            location_childs = {f: [l for l in locations
+                    if f.left <= l.left and l.right <= f.right]
+                for f in from_locations}
+        else:
+            locations = sorted(from_locations, key=lambda l: l.left)
+            location_childs = {f: [f] for f in from_locations}
+        location_order = {l.id: i for i, l in enumerate(locations)}
+
+        with transaction.set_context(
+                stock_date_end=Date.today(),
+                stock_assign=True,
+                forecast=False,
+                number_of_packages=True):
+            pbl = Product.products_by_location(
+                [l.id for l in locations], with_childs=False,
+                grouping=grouping, grouping_filter=(product_ids,))
+
+        available = {}
+        for key, number_of_packages in pbl.items():
+            if not number_of_packages or number_of_packages <= 0:
+                continue
+            values = dict(zip(('location',) + grouping, key))
+            if not values['package']:
+                continue
+            available.setdefault((values['location'], values['product']),
+                []).append(key)
+        balances = {k: int(v) for k, v in pbl.items()}
+        packages = {p.id: p for p in Package.browse(
+                list({k[-1] for keys in available.values() for k in keys}))}
+        lots = {}
+        if Lot:
+            lots = {l.id: l for l in Lot.browse(
+                    list({k[2] for keys in available.values() for k in keys
+                            if k[2]}))}
+
+        def sort_key(key):
+            lot_id = (key[2] or 0) if Lot else 0
+            if order == 'location':
+                return (location_order[key[0]], lot_id)
+            return (lot_id, location_order[key[0]])
+
+        success = True
+        to_write, to_copy, to_assign = [], [], []
+        for move in moves:
+            product = move.product
+            uom = product.default_uom
+            remaining = Uom.compute_qty(move.uom, move.quantity, uom,
+                round=False)
+            keys = []
+            for location in location_childs[move.from_location]:
+                keys.extend(available.get((location.id, product.id), []))
+            picks = []
+            for key in sorted(keys, key=sort_key):
+                if remaining < uom.rounding:
+                    break
+                location_id, package_id = key[0], key[-1]
+                lot_id = key[2] if Lot else None
+                if move.package and move.package.id != package_id:
+                    continue
+                if Lot and move.lot and move.lot.id != lot_id:
+                    continue
+                if lot_id:
+                    package_qty = lots[lot_id].package_qty
+                else:
+                    package_qty = packages[package_id].qty
+                if not package_qty or balances[key] <= 0:
+                    continue
+                number_of_packages = min(balances[key],
+                    int((remaining + uom.rounding / 2) // package_qty))
+                if number_of_packages <= 0:
+                    continue
+                balances[key] -= number_of_packages
+                quantity = uom.round(number_of_packages * package_qty)
+                remaining -= quantity
+                values = {
+                    'from_location': location_id,
+                    'quantity': Uom.compute_qty(uom, quantity, move.uom),
+                    'package': package_id,
+                    'number_of_packages': number_of_packages,
+                    }
+                if Lot:
+                    values['lot'] = lot_id
+                picks.append(values)
+
+            if not picks:
+                success = False
+                continue
+            to_write.extend(([move], picks[0]))
+            to_assign.append(move)
+            for values in picks[1:]:
+                to_copy.append((move, values, True))
+            if remaining >= uom.rounding:
+                success = False
+                values = {
+                    'from_location': move.from_location.id,
+                    'quantity': Uom.compute_qty(uom, remaining, move.uom),
+                    'package': move.package.id if move.package else None,
+                    'number_of_packages': None,
+                    }
+                if Lot:
+                    values['lot'] = move.lot.id if move.lot else None
+                to_copy.append((move, values, False))
+
+        if to_write:
+            cls.write(*to_write)
+        with transaction.set_context(_stock_move_split=True):
+            for move, values, assign in to_copy:
+                new_moves = cls.copy([move], default=values)
+                if assign:
+                    to_assign.extend(new_moves)
+        if to_assign:
+            cls.assign(to_assign)
+        return success
+
+
+class MovePackageDelta(ModelSQL):
+    '''
+    Stock Move Package Delta
+
+    The changes of the number of packages of the keys of the locations made
+    by the moves which reach, leave or are changed in the done state. They
+    are summed by the change feed of package balances.
+    '''
+    __name__ = 'stock.move.package_delta'
+    location = fields.Many2One('stock.location', 'Location', required=True,
+        select=True, ondelete='CASCADE')
+    product = fields.Many2One('product.product', 'Product', required=True,
+        ondelete='CASCADE')
+    package = fields.Many2One('product.pack', 'Package', ondelete='CASCADE')
+    number_of_packages = fields.Integer('Number of packages', required=True)
+
+    @classmethod
+    def package_balance_grouping(cls):
+        return Pool().get('product.product').package_balance_grouping()
+
+    @classmethod
+    def move_fields(cls):
+        "Return the fields of the moves which change their deltas"
+        return ['state', 'from_location', 'to_location',
+            'number_of_packages'] + list(cls.package_balance_grouping())
+
+    @classmethod
+    def get_numbers_of_packages(cls, moves):
+        "Return the number of packages of the done moves by location and key"
+        grouping = cls.package_balance_grouping()
+        result = defaultdict(int)
+        for move in moves:
+            if move.state != 'done' or not move.number_of_packages:
+                continue
+            key = tuple(getattr(move, g).id if getattr(move, g) else None
+                for g in grouping)
+            result[(move.from_location.id,) + key] -= move.number_of_packages
+            result[(move.to_location.id,) + key] += move.number_of_packages
+        return result
+
+    @classmethod
+    def record(cls, moves, before):
+        '''
+        Create the deltas between the number of packages of the moves and
+        the number of packages before.
+        '''
+        grouping = cls.package_balance_grouping()
+        after = cls.get_numbers_of_packages(moves)
+        vlist = []
+        for key in set(before) | set(after):
+            delta = after.get(key, 0) - before.get(key, 0)
+            if delta:
+                values = {
+                    'location': key[0],
+                    'number_of_packages': delta,
+                    }
+                values.update(zip(grouping, key[1:]))
+                vlist.append(values)
+        if vlist:
+            with Transaction().set_context(_check_access=False):
+                cls.create(vlist)
+
+    @classmethod
+    def clean(cls, days=None):
+        '''
+        Delete the deltas older than the days, by default the
+        stock_number_of_packages/change_feed_retention days.
+
+        The consumers of the change feed with an older cursor must read the
+        balances again.
+        '''
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        if days is None:
+            days = config.getint('stock_number_of_packages',
+                'change_feed_retention', default=7)
+        cursor.execute(*table.delete(
+                where=table.create_date < (
+                    datetime.datetime.now() - datetime.timedelta(days=days))))
+
+
+class MovePackageDeltaLot(metaclass=PoolMeta):
+    __name__ = 'stock.move.package_delta'
+    lot = fields.Many2One('stock.lot', 'Lot', ondelete='CASCADE')
@@ -1,5 +1,6 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+from trytond.cache import Cache
 from trytond.model import fields
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Bool, Eval
@@ -13,118 +14,293 @@ __all__ = ['PackagedMixin', 'ProductPack']
 
 class PackagedMixin(object):
     package = fields.Many2One('product.pack', 'Packaging', domain=[
-            ('product.products', 'in', [Eval('product')]),
+            ('id', 'in', Eval('product_packagings', [])),
             ],
         states={
             'invisible': ~Bool(Eval('product')),
             },
-        depends=['product'])
+        depends=['product', 'product_packagings'])
+    product_packagings = fields.Function(fields.Many2Many('product.pack',
+            None, None, 'Product Packagings'),
+        'get_product_packagings')
     number_of_packages = fields.Integer('Number of packages', states={
             'invisible': ~Bool(Eval('product')) | ~Bool(Eval('package')),
             },
         depends=['product', 'package'])
 
-    @fields.depends('product', 'package', methods=['on_change_package'])
+    @fields.depends('product')
+    def on_change_with_product_packagings(self, name=None):
+        pool = Pool()
+        Package = pool.get('product.pack')
+        if not self.product:
+            return []
+        return Package.get_product_packagings([self.product])[self.product.id]
+
+    @classmethod
+    def get_product_packagings(cls, records, name):
+        pool = Pool()
+        Package = pool.get('product.pack')
+        packagings = Package.get_product_packagings(
+            [r.product for r in records if r.product])
+        return {r.id: packagings[r.product.id] if r.product else []
+            for r in records}
+
+    @fields.depends('product', 'package', methods=['on_change_package',
+            'on_change_with_product_packagings'])
     def on_change_product(self):
         super(PackagedMixin, self).on_change_product()
-        if self.product and (not self.package or
-                self.package.product != self.product.template):
+        if self.product and (not self.package or self.package.id not in
+                self.on_change_with_product_packagings()):
             if self.product.default_package:
                 self.package = self.product.default_package
                 self.on_change_package()
             else:
                 self.package = None
 
+    def _get_package_qty(self):
+        "Return the quantity by package of the lot or of the packaging"
+        if getattr(self, 'lot', None):
+            return self.lot.package_qty
+        if self.package:
+            return self.package.qty
+
     @fields.depends('package', 'quantity', 'number_of_packages')
     def on_change_package(self):
-        if hasattr(self, 'lot') and getattr(self, 'lot', None):
-            package_qty = self.lot.package_qty
-        elif self.package and self.package.qty:
-            package_qty = self.package.qty
-        else:
-            return
-        if ((self.number_of_packages or self.number_of_packages == 0) and
-                package_qty):
+        package_qty = self._get_package_qty()
+        if self.number_of_packages is not None and package_qty:
             self.quantity = self.number_of_packages * package_qty
 
     @fields.depends('package', 'lot', 'number_of_packages')
     def on_change_number_of_packages(self):
         self.quantity = None
         if self.number_of_packages is not None:
-            if hasattr(self, 'lot') and getattr(self, 'lot', None):
-                package_qty = self.lot.package_qty
-            elif self.package and self.package.qty:
-                package_qty = self.package.qty
-            else:
-                return
-            self.quantity = package_qty * self.number_of_packages
+            package_qty = self._get_package_qty()
+            if package_qty:
+                self.quantity = package_qty * self.number_of_packages
 
     def check_package(self, quantity):
         """
         Check if package is required and all realted data is exists, and
         if number of packages corresponds to the quantity.
         """
+        self.check_packages([self], [quantity])
+
+    @classmethod
+    def check_packages(cls, records, quantities):
+        '''
+        Check the packages of the records with their quantities in the
+        product unit in a single pass.
+
+        The quantities by package of the packagings and lots are read once
+        for all the records.
+        '''
+        pool = Pool()
+        Package = pool.get('product.pack')
         if Transaction().context.get(
                 'no_check_quantity_number_of_packages'):
             return
 
-        if hasattr(self, 'uom'):
-            uom = self.uom
-        elif hasattr(self, 'unit'):
-            uom = self.unit
-        else:
-            uom = None
-        if (not self.product.package_required or
-                self.quantity < uom.rounding):
-            return
-
-        if not self.package:
-            raise UserError(gettext(
-                'stock_number_of_packages.package_required',
-                line=self.rec_name))
-
-        if self.number_of_packages is None:
-            raise UserError(gettext(
-                'stock_number_of_packages.number_of_packages_required',
-                    line=self.rec_name))
+        to_check = []
+        for record, quantity in zip(records, quantities):
+            if hasattr(record, 'uom'):
+                uom = record.uom
+            elif hasattr(record, 'unit'):
+                uom = record.unit
+            else:
+                uom = None
+            if (not record.product.package_required
+                    or (record.quantity or 0) < uom.rounding):
+                continue
 
-        if hasattr(self, 'lot') and getattr(self, 'lot', None):
-            if not self.lot.package or self.lot.package != self.package:
+            if not record.package:
                 raise UserError(gettext(
-                    'stock_number_of_packages.invalid_lot_package',
-                    line=self.rec_name))
-            if not self.lot.package_qty:
+                    'stock_number_of_packages.package_required',
+                    line=record.rec_name))
+
+            if record.number_of_packages is None:
                 raise UserError(gettext(
-                    'stock_number_of_packages.lot_package_qty_required',
-                    lot=self.lot.rec_name,
-                    record=self.rec_name))
-            package_qty = self.lot.package_qty
-        else:
-            if not self.package.qty:
+                    'stock_number_of_packages.number_of_packages_required',
+                        line=record.rec_name))
+
+            lot = getattr(record, 'lot', None)
+            if lot:
+                if not lot.package or lot.package != record.package:
+                    raise UserError(gettext(
+                        'stock_number_of_packages.invalid_lot_package',
+                        line=record.rec_name))
+                if not lot.package_qty:
+                    raise UserError(gettext(
+                        'stock_number_of_packages.lot_package_qty_required',
+                        lot=lot.rec_name,
+                        record=record.rec_name))
+            elif not record.package.qty:
                 raise UserError(gettext(
                     'stock_number_of_packages.package_qty_required',
-                    package=self.package.rec_name,
-                    record=self.rec_name))
-            package_qty = self.package.qty
+                    package=record.package.rec_name,
+                    record=record.rec_name))
+            to_check.append((record, lot, quantity))
+        if not to_check:
+            return
 
-        if (abs(quantity - (self.number_of_packages * package_qty)) >
-                self.product.default_uom.rounding):
-            raise UserError(gettext(
-                'stock_number_of_packages.invalid_quantity_number_of_packages',
-                line=self.rec_name))
+        checks = Package.check_numbers_of_packages(
+            [r.product for r, _, _ in to_check],
+            [l for _, l, _ in to_check],
+            [r.package for r, _, _ in to_check],
+            [q for _, _, q in to_check],
+            [r.number_of_packages for r, _, _ in to_check])
+        for (record, _, _), valid in zip(to_check, checks):
+            if not valid:
+                raise UserError(gettext(
+                    'stock_number_of_packages'
+                    '.invalid_quantity_number_of_packages',
+                    line=record.rec_name))
 
 
 class ProductPack(metaclass=PoolMeta):
     __name__ = 'product.pack'
+    _product_packagings_cache = Cache('product.pack.product_packagings',
+        context=False)
 
     @classmethod
     def __setup__(cls):
         super(ProductPack, cls).__setup__()
+        cls.product.select = True
         cls._modify_no_move = [
             ('product', 'change_product'),
             ('qty', 'change_qty'),
             ]
 
+    @classmethod
+    def get_product_packagings(cls, products):
+        '''
+        Return a dictionary with the packaging ids of each product.
+
+        The lists are cached per product and computed with a single search
+        on the template of the missing products.
+        '''
+        result, missing = {}, []
+        for product in products:
+            packagings = cls._product_packagings_cache.get(product.id)
+            if packagings is None:
+                missing.append(product)
+            else:
+                result[product.id] = list(packagings)
+        if missing:
+            template2packagings = {}
+            for packaging in cls.search([
+                        ('product', 'in',
+                            list({p.template.id for p in missing})),
+                        ]):
+                template2packagings.setdefault(
+                    packaging.product.id, []).append(packaging.id)
+            for product in missing:
+                packagings = template2packagings.get(product.template.id, [])
+                cls._product_packagings_cache.set(product.id, packagings)
+                result[product.id] = list(packagings)
+        return result
+
+    @classmethod
+    def get_package_quantities(cls, products, lots, packages):
+        '''
+        Return the quantity by package and the unit of each product, lot and
+        packaging of the parallel lists.
+
+        The quantity by package is taken from the lot if any or from the
+        packaging. Records or ids are accepted, the ids are read in batch.
+        '''
+        pool = Pool()
+        Product = pool.get('product.product')
+
+        def instances(Model, records):
+            # Keep the given instances, they may not be saved
+            ids = list({int(r) for r in records
+                    if r is not None and not isinstance(r, Model)})
+            browsed = {r.id: r for r in Model.browse(ids)}
+            return [r if r is None or isinstance(r, Model)
+                else browsed[int(r)] for r in records]
+        products = instances(Product, products)
+        packages = instances(cls, packages)
+        if any(l is not None for l in lots):
+            lots = instances(pool.get('stock.lot'), lots)
+
+        result = []
+        for product, lot, package in zip(products, lots, packages):
+            uom = product.default_uom if product else None
+            if lot is not None:
+                package_qty = lot.package_qty
+            elif package is not None:
+                package_qty = package.qty
+            else:
+                package_qty = None
+            result.append((package_qty, uom))
+        return result
+
+    @classmethod
+    def compute_quantities(cls, products, lots, packages,
+            numbers_of_packages):
+        '''
+        Return the quantities in the product unit of the numbers of packages
+        of the parallel lists, None when unknown.
+        '''
+        result = []
+        for (package_qty, uom), number_of_packages in zip(
+                cls.get_package_quantities(products, lots, packages),
+                numbers_of_packages):
+            if not package_qty or number_of_packages is None:
+                result.append(None)
+                continue
+            quantity = number_of_packages * package_qty
+            result.append(uom.round(quantity) if uom else quantity)
+        return result
+
+    @classmethod
+    def compute_numbers_of_packages(cls, products, lots, packages,
+            quantities):
+        '''
+        Return the number of packages of the quantities in the product unit
+        of the parallel lists and if they are a whole number of packages.
+        The number of packages is None when unknown.
+        '''
+        result = []
+        for (package_qty, uom), quantity in zip(
+                cls.get_package_quantities(products, lots, packages),
+                quantities):
+            if not package_qty or quantity is None:
+                result.append((None, False))
+                continue
+            number_of_packages = int(round(quantity / package_qty))
+            rounding = uom.rounding if uom else 0
+            result.append((number_of_packages,
+                    abs(quantity - number_of_packages * package_qty)
+                    <= rounding))
+        return result
+
+    @classmethod
+    def check_numbers_of_packages(cls, products, lots, packages, quantities,
+            numbers_of_packages):
+        '''
+        Return if each quantity in the product unit corresponds to its
+        number of packages in the parallel lists.
+        '''
+        result = []
+        for (package_qty, uom), quantity, number_of_packages in zip(
+                cls.get_package_quantities(products, lots, packages),
+                quantities, numbers_of_packages):
+            if (not package_qty or quantity is None
+                    or number_of_packages is None):
+                result.append(False)
+                continue
+            rounding = uom.rounding if uom else 0
+            result.append(abs(quantity - number_of_packages * package_qty)
+                <= rounding)
+        return result
+
+    @classmethod
+    def create(cls, vlist):
+        packagings = super(ProductPack, cls).create(vlist)
+        cls._product_packagings_cache.clear()
+        return packagings
+
     @classmethod
     def write(cls, *args):
         if (Transaction().user != 0
@@ -142,12 +318,14 @@ class ProductPack(metaclass=PoolMeta):
                         cls.check_no_move(modified_packagins, error)
                         break
         super(ProductPack, cls).write(*args)
+        cls._product_packagings_cache.clear()
 
     @classmethod
     def delete(cls, packagings):
         cls.check_no_move(packagings,
             'stock_number_of_packages.delete_packaging')
         super(ProductPack, cls).delete(packagings)
+        cls._product_packagings_cache.clear()
 
     @classmethod
     def check_no_move(cls, packagings, error):
@@ -1,10 +1,22 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import mmap
+import os
+from bisect import bisect_left, bisect_right
+import shutil
+from array import array
+from sql import Column, Null
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.exceptions import UserError
+from trytond.i18n import gettext
 from trytond.model import ModelSQL, ModelView, fields
 from trytond.pool import Pool, PoolMeta
+from trytond.tools import grouped_slice, reduce_ids
 from trytond.transaction import Transaction
 
-__all__ = ['Period', 'PeriodCache', 'PeriodCacheLot', 'PeriodCachePackage']
+__all__ = ['Cron', 'Period', 'PeriodLot', 'PeriodCache', 'PeriodCacheLot',
+    'PeriodCachePackage', 'PeriodCacheLotPackage']
 
 
 class NumberOfPackagesCacheMixin(object):
@@ -17,11 +29,16 @@ class NumberOfPackagesCacheMixin(object):
         Product = pool.get('product.product')
 
         vlist_by_period_location = {}
+        computed = []
         for values in vlist:
+            if 'number_of_packages' in values:
+                computed.append(values)
+                continue
             vlist_by_period_location.setdefault(values['period'], {})\
                 .setdefault(values['location'], []).append(values)
 
-        vlist = []
+        vlist = [v for v in computed
+            if v.get('internal_quantity') or v['number_of_packages']]
         for period_id, vlist_by_location in \
                 vlist_by_period_location.items():
             period = Period(period_id)
@@ -41,20 +58,374 @@ class NumberOfPackagesCacheMixin(object):
                 for values in location_vlist:
                     key = tuple([location_id] + [values[x] for x in grouping])
                     values['number_of_packages'] = int(pbl.get(key, 0.0))
-                    vlist.append(values)
+                    # A missing key is read as zero
+                    if (values.get('internal_quantity')
+                            or values['number_of_packages']):
+                        vlist.append(values)
         return vlist
 
 
+class _RemoveDirectoriesDataManager(object):
+    "Remove the directories once the transaction is committed"
+
+    def __init__(self):
+        self.paths = set()
+
+    def __eq__(self, other):
+        if not isinstance(other, _RemoveDirectoriesDataManager):
+            return NotImplemented
+        return True
+
+    def abort(self, trans):
+        self.paths.clear()
+
+    def tpc_begin(self, trans):
+        pass
+
+    def commit(self, trans):
+        pass
+
+    def tpc_vote(self, trans):
+        pass
+
+    def tpc_finish(self, trans):
+        for path in self.paths:
+            shutil.rmtree(path, ignore_errors=True)
+        self.paths.clear()
+
+    def tpc_abort(self, trans):
+        self.paths.clear()
+
+
 class Period(metaclass=PoolMeta):
     __name__ = 'stock.period'
+    _closed_periods_cache = Cache('stock.period.closed_periods',
+        context=False)
 
     package_caches = fields.One2Many('stock.period.cache.package', 'period',
         'Package Caches', readonly=True)
+    caches_archived = fields.Boolean('Caches Archived', readonly=True)
+
+    @staticmethod
+    def default_caches_archived():
+        return False
 
     @classmethod
     def groupings(cls):
         return super(Period, cls).groupings() + [('product', 'package')]
 
+    @classmethod
+    def write(cls, *args):
+        super(Period, cls).write(*args)
+        cls._closed_periods_cache.clear()
+
+    @classmethod
+    @ModelView.button
+    def draft(cls, periods):
+        archived = [p for p in periods if p.caches_archived]
+        super(Period, cls).draft(periods)
+        if archived:
+            cls.write(archived, {'caches_archived': False})
+            cls._remove_archives(archived)
+
+    @classmethod
+    def delete(cls, periods):
+        archived = [p for p in periods if p.caches_archived]
+        super(Period, cls).delete(periods)
+        cls._closed_periods_cache.clear()
+        cls._remove_archives(archived)
+
+    @classmethod
+    def get_closed_periods(cls, company_id):
+        '''
+        Return the date, id and archived flag of the closed periods of the
+        company from the latest.
+        '''
+        if not company_id:
+            return []
+        periods = cls._closed_periods_cache.get(company_id)
+        if periods is None:
+            periods = [(p.date, p.id, p.caches_archived)
+                for p in cls.search([
+                        ('state', '=', 'closed'),
+                        ('company', '=', company_id),
+                        ], order=[('date', 'DESC')])]
+            cls._closed_periods_cache.set(company_id, periods)
+        return periods
+
+    @classmethod
+    def _archive_period_directory(cls, period):
+        path = config.get('stock_number_of_packages', 'archive_path',
+            default=os.path.join(
+                config.get('database', 'path'), 'stock_period_caches'))
+        return os.path.join(path, Transaction().database.name,
+            str(period.id))
+
+    @classmethod
+    def _archive_directory(cls, period, Cache):
+        return os.path.join(cls._archive_period_directory(period),
+            Cache.__name__)
+
+    @classmethod
+    def _remove_archives(cls, periods):
+        "Remove the archived caches of the periods when committed"
+        datamanager = Transaction().join(_RemoveDirectoriesDataManager())
+        datamanager.paths.update(
+            cls._archive_period_directory(p) for p in periods)
+
+    @classmethod
+    def archive_caches(cls, periods=None):
+        '''
+        Move the cache rows of the periods to columnar files.
+
+        By default all the closed periods are archived. The latest closed
+        period of each company is never archived as it is read by the stock
+        queries.
+        Each column is stored as a file of native integers or floats which
+        can be memory-mapped, sorted by location and product so the reads
+        can search them.
+        '''
+        cursor = Transaction().connection.cursor()
+        if periods is None:
+            periods = cls.search([
+                    ('state', '=', 'closed'),
+                    ('caches_archived', '=', False),
+                    ])
+
+        def latest(period):
+            return cls.get_closed_periods(period.company.id)[0][1]
+        periods = [p for p in periods
+            if p.state == 'closed' and not p.caches_archived
+            and p.id != latest(p)]
+
+        for period in periods:
+            for grouping in cls.groupings():
+                Cache = cls.get_cache(grouping)
+                if not Cache or 'number_of_packages' not in Cache._fields:
+                    continue
+                cache = Cache.__table__()
+                directory = cls._archive_directory(period, Cache)
+                os.makedirs(directory, exist_ok=True)
+                columns = [('location', 'q')] + [(g, 'q') for g in grouping]
+                columns += [('internal_quantity', 'd'),
+                    ('number_of_packages', 'q')]
+                cursor.execute(*cache.select(
+                        *[Column(cache, c) for c, _ in columns],
+                        where=cache.period == period.id,
+                        order_by=[cache.location.asc, cache.product.asc]))
+                files = [open(os.path.join(directory, c), 'wb')
+                    for c, _ in columns]
+                try:
+                    for rows in iter(lambda: cursor.fetchmany(10000), []):
+                        for i, (file, (_, typecode)) in enumerate(
+                                zip(files, columns)):
+                            array(typecode,
+                                (r[i] or 0 for r in rows)).tofile(file)
+                finally:
+                    for file in files:
+                        file.close()
+                cursor.execute(*cache.delete(
+                        where=cache.period == period.id))
+        if periods:
+            cls.write(periods, {'caches_archived': True})
+
+    @classmethod
+    def read_archived_cache(cls, period, grouping, location_ids,
+            grouping_filter=None, quantity_field='internal_quantity'):
+        '''
+        Return a dictionary with the quantity field of the archived cache of
+        the period by location and grouping.
+
+        The rows of the locations and products are searched in the sorted
+        columns, so only the matching rows are read. A missing column file,
+        like for a grouping added after the archive, is an empty cache.
+        '''
+        Cache = cls.get_cache(grouping)
+        directory = cls._archive_directory(period, Cache)
+        columns = [('location', 'q')] + [(g, 'q') for g in grouping]
+        columns.append((quantity_field,
+                'd' if quantity_field == 'internal_quantity' else 'q'))
+        filters = [set(location_ids)] + [
+            set(ids) if ids is not None else None
+            for ids in (grouping_filter or [])]
+        filters += [None] * (len(columns) - 1 - len(filters))
+
+        result = {}
+        maps, views = [], []
+        try:
+            for name, typecode in columns:
+                try:
+                    file = open(os.path.join(directory, name), 'rb')
+                except FileNotFoundError:
+                    return result
+                with file:
+                    if not os.fstat(file.fileno()).st_size:
+                        return result
+                    maps.append(mmap.mmap(file.fileno(), 0,
+                            access=mmap.ACCESS_READ))
+                views.append(memoryview(maps[-1]).cast(typecode))
+
+            locations, products = views[0], views[1]
+            ranges = []
+            for location_id in sorted(filters[0]):
+                start = bisect_left(locations, location_id)
+                end = bisect_right(locations, location_id, start)
+                if filters[1] is None:
+                    ranges.append((start, end))
+                    continue
+                for product_id in sorted(filters[1]):
+                    lo = bisect_left(products, product_id, start, end)
+                    ranges.append(
+                        (lo, bisect_right(products, product_id, lo, end)))
+            other_filters = list(enumerate(filters))[2:]
+            for start, end in ranges:
+                for i in range(start, end):
+                    row = [v[i] for v in views]
+                    if all(f is None or (row[j] or None) in f
+                            for j, f in other_filters):
+                        key = tuple(v or None for v in row[:-1])
+                        result[key] = row[-1]
+        finally:
+            for view in views:
+                view.release()
+            for map_ in maps:
+                map_.close()
+        return result
+
+    @classmethod
+    def repair_caches(cls, moves):
+        '''
+        Recompute the cache keys of the moves in the closed periods of their
+        company after their effective date.
+        The archived periods can not be repaired, they must be set back to
+        draft and closed again.
+        '''
+        moves_by_company = {}
+        for move in moves:
+            if move.effective_date:
+                moves_by_company.setdefault(move.company, []).append(move)
+        for company, company_moves in moves_by_company.items():
+            periods = cls.search([
+                    ('company', '=', company.id),
+                    ('state', '=', 'closed'),
+                    ('date', '>=',
+                        min(m.effective_date for m in company_moves)),
+                    ], order=[('date', 'ASC')])
+            if not periods:
+                continue
+            for period in periods:
+                if period.caches_archived:
+                    raise UserError(gettext(
+                            'stock_number_of_packages.repair_archived_period',
+                            period=period.rec_name))
+            with Transaction().set_context(company=company.id):
+                cls._repair_caches(periods, company_moves)
+
+    @classmethod
+    def _repair_caches(cls, periods, moves):
+        pool = Pool()
+        Product = pool.get('product.product')
+
+        def id_(record):
+            return record.id if record else None
+
+        for grouping in cls.groupings():
+            Cache = cls.get_cache(grouping)
+            if not Cache:
+                continue
+            key_dates = {}
+            for move in moves:
+                if not move.effective_date:
+                    continue
+                values = tuple(id_(getattr(move, g)) for g in grouping)
+                for location in (move.from_location, move.to_location):
+                    key = (location.id,) + values
+                    key_dates[key] = min(move.effective_date,
+                        key_dates.get(key, move.effective_date))
+            location_ids = list({k[0] for k in key_dates})
+            product_ids = list({k[1] for k in key_dates})
+
+            for period in periods:
+                keys = {k for k, d in key_dates.items() if d <= period.date}
+                if not keys:
+                    continue
+                with Transaction().set_context(
+                        stock_date_end=period.date,
+                        stock_date_start=None,
+                        stock_assign=False,
+                        forecast=False,
+                        stock_destinations=None):
+                    quantities = Product.products_by_location(location_ids,
+                        grouping=grouping, grouping_filter=(product_ids,))
+                    with Transaction().set_context(number_of_packages=True):
+                        packages = Product.products_by_location(
+                            location_ids, grouping=grouping,
+                            grouping_filter=(product_ids,))
+                caches = {}
+                for cache in Cache.search([
+                            ('period', '=', period.id),
+                            ('location', 'in', location_ids),
+                            ('product', 'in', product_ids),
+                            ]):
+                    key = (cache.location.id,) + tuple(
+                        id_(getattr(cache, g)) for g in grouping)
+                    caches[key] = cache
+
+                to_create, to_write, to_delete = [], [], []
+                for key in keys:
+                    quantity = quantities.get(key) or 0
+                    number_of_packages = int(packages.get(key) or 0)
+                    cache = caches.get(key)
+                    if not quantity and not number_of_packages:
+                        if cache:
+                            to_delete.append(cache)
+                    elif cache:
+                        to_write.extend(([cache], {
+                                    'internal_quantity': quantity,
+                                    'number_of_packages': number_of_packages,
+                                    }))
+                    else:
+                        values = {
+                            'period': period.id,
+                            'location': key[0],
+                            'internal_quantity': quantity,
+                            'number_of_packages': number_of_packages,
+                            }
+                        values.update(zip(grouping, key[1:]))
+                        to_create.append(values)
+                if to_delete:
+                    Cache.delete(to_delete)
+                if to_write:
+                    Cache.write(*to_write)
+                if to_create:
+                    Cache.create(to_create)
+                # The next periods are computed from this one
+                Product.clear_number_of_packages_cache(done=True)
+
+    @classmethod
+    def compact_caches(cls, periods=None):
+        '''
+        Delete the cache rows without quantity nor number of packages of the
+        periods or of all the closed periods.
+        '''
+        cursor = Transaction().connection.cursor()
+        if periods is None:
+            periods = cls.search([('state', '=', 'closed')])
+        caches = {cls.get_cache(g) for g in cls.groupings()}
+        for PeriodCache in caches:
+            if (not PeriodCache
+                    or 'number_of_packages' not in PeriodCache._fields):
+                continue
+            cache = PeriodCache.__table__()
+            for sub_periods in grouped_slice(periods):
+                cursor.execute(*cache.delete(
+                        where=reduce_ids(cache.period,
+                            [p.id for p in sub_periods])
+                        & ((cache.internal_quantity == Null)
+                            | (cache.internal_quantity == 0))
+                        & ((cache.number_of_packages == Null)
+                            | (cache.number_of_packages == 0))))
+
     @classmethod
     def get_cache(cls, grouping):
         pool = Pool()
@@ -64,6 +435,40 @@ class Period(metaclass=PoolMeta):
         return Cache
 
 
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super(Cron, cls).__setup__()
+        cls.method.selection.extend([
+                ('stock.period|compact_caches', 'Compact Stock Period Caches'),
+                ('stock.period|archive_caches', 'Archive Stock Period Caches'),
+                ('stock.move.package_delta|clean',
+                    'Clean Stock Move Package Deltas'),
+                ])
+
+
+class PeriodLot(metaclass=PoolMeta):
+    __name__ = 'stock.period'
+
+    lot_package_caches = fields.One2Many('stock.period.cache.lot.package',
+        'period', 'Lot Package Caches', readonly=True)
+
+    @classmethod
+    def groupings(cls):
+        return super(PeriodLot, cls).groupings() + [
+            ('product', 'lot', 'package')]
+
+    @classmethod
+    def get_cache(cls, grouping):
+        pool = Pool()
+        Cache = super(PeriodLot, cls).get_cache(grouping)
+        if grouping == ('product', 'lot', 'package'):
+            return pool.get('stock.period.cache.lot.package')
+        return Cache
+
+
 class PeriodCache(NumberOfPackagesCacheMixin, metaclass=PoolMeta):
     __name__ = 'stock.period.cache'
 
@@ -104,3 +509,30 @@ class PeriodCachePackage(ModelSQL, ModelView, NumberOfPackagesCacheMixin):
         vlist = cls.compute_number_of_packages(vlist,
             ('product', 'package'))
         return super(PeriodCachePackage, cls).create(vlist)
+
+
+class PeriodCacheLotPackage(ModelSQL, ModelView, NumberOfPackagesCacheMixin):
+    '''
+    Stock Period Cache per Lot and Package
+
+    It is used to store cached computation of stock quantities per lot and
+    package.
+    '''
+    __name__ = 'stock.period.cache.lot.package'
+    period = fields.Many2One('stock.period', 'Period', required=True,
+        readonly=True, select=True, ondelete='CASCADE')
+    location = fields.Many2One('stock.location', 'Location', required=True,
+        readonly=True, select=True, ondelete='CASCADE')
+    product = fields.Many2One('product.product', 'Product', required=True,
+        readonly=True, ondelete='CASCADE')
+    lot = fields.Many2One('stock.lot', 'Lot', readonly=True,
+        ondelete='CASCADE')
+    package = fields.Many2One('product.pack', 'Package', readonly=True,
+        ondelete='CASCADE')
+    internal_quantity = fields.Float('Internal Quantity', readonly=True)
+
+    @classmethod
+    def create(cls, vlist):
+        vlist = cls.compute_number_of_packages(vlist,
+            ('product', 'lot', 'package'))
+        return super(PeriodCacheLotPackage, cls).create(vlist)
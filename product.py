@@ -1,13 +1,66 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
-from decimal import Decimal
+import datetime
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
+from itertools import groupby
+from weakref import WeakKeyDictionary
+from sql import Column, Literal, Union, Window
+from sql.aggregate import Sum
+from sql.conditionals import Coalesce
+from trytond.cache import Cache
+from trytond.config import config
 from trytond.model import fields
-from trytond.pool import PoolMeta
+from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval
+from trytond.rpc import RPC
+from trytond.transaction import Transaction
 from trytond.modules.stock_number_of_packages.move import StockMixin
 
 __all__ = ['Template', 'Product']
 
+# Results of products_by_location with number_of_packages in the context,
+# memoized per transaction
+_number_of_packages_cache = WeakKeyDictionary()
+_NUMBER_OF_PACKAGES_CACHE_CONTEXT = ('company', 'forecast', 'stock_assign',
+    'stock_date_start', 'stock_date_end', 'stock_destinations',
+    'stock_skip_warehouse')
+# Transactions which modified moves and must not use the shared cache
+_number_of_packages_dirty = WeakKeyDictionary()
+
+
+class _NumberOfPackagesCacheDataManager(object):
+    "Clear the number of packages memo once the transaction is committed"
+
+    def __eq__(self, other):
+        if not isinstance(other, _NumberOfPackagesCacheDataManager):
+            return NotImplemented
+        return True
+
+    def clear(self, trans):
+        _number_of_packages_cache.pop(trans, None)
+        _number_of_packages_dirty.pop(trans, None)
+
+    def abort(self, trans):
+        self.clear(trans)
+
+    def tpc_begin(self, trans):
+        pass
+
+    def commit(self, trans):
+        pass
+
+    def tpc_vote(self, trans):
+        pass
+
+    def tpc_finish(self, trans):
+        self.clear(trans)
+
+    def tpc_abort(self, trans):
+        self.clear(trans)
+
+
 class Template(metaclass=PoolMeta):
     __name__ = 'product.template'
 
@@ -24,12 +77,12 @@ class Template(metaclass=PoolMeta):
             states={
                 'invisible': ~Eval('package_required', False),
                 }, depends=['package_required']),
-        'sum_product')
+        'get_number_of_packages')
     forecast_number_of_packages = fields.Function(
         fields.Float('Forecast Number of packages', states={
                 'invisible': ~Eval('package_required', False),
                 }, depends=['package_required']),
-        'sum_product')
+        'get_number_of_packages')
 
     @classmethod
     def __setup__(cls):
@@ -37,17 +90,267 @@ class Template(metaclass=PoolMeta):
         cls._modify_no_move.append(
             ('package_required', 'change_package_required'))
 
-    def sum_product(self, name):
-        if name not in ('number_of_packages', 'forecast_number_of_packages'):
-            return super(Template, self).sum_product(name)
-        sum_ = 0. if name != 'cost_value' else Decimal(0)
-        for product in self.products:
-            sum_ += getattr(product, name)
-        return sum_
+    @classmethod
+    def get_number_of_packages(cls, templates, name):
+        pool = Pool()
+        Product = pool.get('product.product')
+        # Browse the products of all the templates together to compute them
+        # with a single query
+        products = Product.browse(
+            [p.id for t in templates for p in t.products])
+        quantities = {p.id: getattr(p, name) or 0 for p in products}
+        return {t.id: float(sum(quantities[p.id] for p in t.products))
+            for t in templates}
 
 
 class Product(StockMixin, metaclass=PoolMeta):
     __name__ = 'product.product'
+    _number_of_packages_shared_cache = Cache(
+        'product.product.number_of_packages',
+        size_limit=config.getint(
+            'stock_number_of_packages', 'cache_size', default=1024),
+        duration=datetime.timedelta(seconds=config.getint(
+                'stock_number_of_packages', 'cache_duration', default=300)),
+        context=False)
+
+    @classmethod
+    def __setup__(cls):
+        super(Product, cls).__setup__()
+        cls.__rpc__.update({
+                'get_package_balances': RPC(),
+                'get_package_balance_changes': RPC(),
+                })
+
+    @classmethod
+    def products_by_location(cls, location_ids, with_childs=False,
+            grouping=('product',), grouping_filter=None):
+        '''
+        Memoize number of packages results in the transaction.
+
+        A request is answered from a cached result computed for a superset
+        of its locations and grouping filter.
+        Results which only depend on done moves are also shared between the
+        processes until a move reaches or leaves the done state.
+        '''
+        transaction = Transaction()
+        context = transaction.context
+        if not context.get('number_of_packages'):
+            return cls._products_by_location(location_ids,
+                with_childs=with_childs, grouping=grouping,
+                grouping_filter=grouping_filter)
+
+        # Record rules depend on the user
+        key = (transaction.user, with_childs, tuple(grouping)) + tuple(
+            cls._freeze_cache_value(context.get(k))
+            for k in _NUMBER_OF_PACKAGES_CACHE_CONTEXT)
+        locations = frozenset(location_ids)
+        filters = cls._number_of_packages_cache_filter(grouping,
+            grouping_filter)
+        cache = _number_of_packages_cache.setdefault(transaction, {})
+        # Other transactions may commit moves once this one ends
+        transaction.join(_NumberOfPackagesCacheDataManager())
+        for cached_locations, cached_filters, quantities in cache.get(
+                key, []):
+            if (locations <= cached_locations
+                    and all(c is None or (f is not None and f <= c)
+                        for f, c in zip(filters, cached_filters))):
+                result = copy(quantities)
+                for qkey in list(result.keys()):
+                    if (qkey[0] not in locations
+                            or any(f is not None and v not in f
+                                for f, v in zip(filters, qkey[1:]))):
+                        del result[qkey]
+                return result
+
+        shared_key = cls._number_of_packages_shared_key(key, locations,
+            filters)
+        quantities = None
+        if shared_key:
+            quantities = cls._number_of_packages_shared_cache.get(shared_key)
+            if quantities is not None:
+                quantities = copy(quantities)
+        if quantities is None:
+            quantities = cls._products_by_location(location_ids,
+                with_childs=with_childs, grouping=grouping,
+                grouping_filter=grouping_filter)
+            if shared_key:
+                cls._number_of_packages_shared_cache.set(shared_key,
+                    copy(quantities))
+        cache.setdefault(key, []).append(
+            (locations, filters, copy(quantities)))
+        return quantities
+
+    @classmethod
+    def _products_by_location(cls, location_ids, with_childs=False,
+            grouping=('product',), grouping_filter=None):
+        '''
+        Compute products_by_location adding the archived cache of the
+        period it starts from to the moves after it.
+        '''
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Period = pool.get('stock.period')
+        context = Transaction().context
+
+        grouping = tuple(grouping)
+        period = cls._archived_period(grouping)
+        if not period:
+            return super(Product, cls).products_by_location(location_ids,
+                with_childs=with_childs, grouping=grouping,
+                grouping_filter=grouping_filter)
+
+        with Transaction().set_context(
+                stock_date_start=period.date + datetime.timedelta(days=1)):
+            quantities = super(Product, cls).products_by_location(
+                location_ids, with_childs=with_childs, grouping=grouping,
+                grouping_filter=grouping_filter)
+
+        locations = Location.browse(location_ids)
+        if with_childs:
+            childs = Location.search([
+                    ('parent', 'child_of', location_ids),
+                    ])
+        else:
+            childs = locations
+        quantity_field = ('number_of_packages'
+            if context.get('number_of_packages') else 'internal_quantity')
+        archived = Period.read_archived_cache(period, grouping,
+            [c.id for c in childs], grouping_filter=grouping_filter,
+            quantity_field=quantity_field)
+        childs = {c.id: c for c in childs}
+        for key, quantity in archived.items():
+            child = childs[key[0]]
+            for location in locations:
+                if (location.id == child.id or (with_childs
+                            and location.left <= child.left
+                            and child.right <= location.right)):
+                    lkey = (location.id,) + key[1:]
+                    quantities[lkey] = (quantities.get(lkey) or 0) + quantity
+        return quantities
+
+    @classmethod
+    def _archived_period(cls, grouping):
+        '''
+        Return the period the stock of the grouping starts from if its cache
+        is archived.
+        '''
+        pool = Pool()
+        Period = pool.get('stock.period')
+        User = pool.get('res.user')
+        context = Transaction().context
+
+        if (context.get('stock_date_start')
+                or tuple(grouping) not in Period.groupings()):
+            return
+        # The period is picked like compute_quantities_query does
+        company = User(Transaction().user).company
+        date_end = context.get('stock_date_end') or datetime.date.max
+        # The closed periods are cached to not search them on each read
+        for date, period_id, archived in Period.get_closed_periods(
+                company.id if company else None):
+            if date <= date_end:
+                if archived:
+                    return Period(period_id)
+                return
+
+    @classmethod
+    def products_by_location_parallel(cls, location_ids, with_childs=False,
+            grouping=('product',), grouping_filter=None):
+        '''
+        Compute products_by_location for each location concurrently in
+        read-only transactions and return the merged result.
+
+        The locations are computed in the current transaction when it is not
+        read-only because the other connections could not see its changes,
+        or when the database is in memory as it is not shared.
+        Each location is computed in its own transaction, so the result is
+        not a single snapshot: a move committed meanwhile may be counted in
+        some locations only.
+        '''
+        transaction = Transaction()
+        location_ids = list(location_ids)
+        max_workers = config.getint('stock_number_of_packages',
+            'max_workers', default=4)
+        if (len(location_ids) < 2 or max_workers < 2
+                or not transaction.readonly
+                or transaction.database.name == ':memory:'):
+            return cls.products_by_location(location_ids,
+                with_childs=with_childs, grouping=grouping,
+                grouping_filter=grouping_filter)
+
+        database_name = transaction.database.name
+        user = transaction.user
+        context = dict(transaction.context)
+
+        def compute(location_id):
+            with Transaction().start(database_name, user, readonly=True,
+                    context=context):
+                Product = Pool().get('product.product')
+                return Product.products_by_location([location_id],
+                    with_childs=with_childs, grouping=grouping,
+                    grouping_filter=grouping_filter)
+
+        result = {}
+        with ThreadPoolExecutor(
+                max_workers=min(max_workers, len(location_ids))) as executor:
+            for quantities in executor.map(compute, location_ids):
+                result.update(quantities)
+        return result
+
+    @staticmethod
+    def _freeze_cache_value(value):
+        if isinstance(value, (list, set)):
+            return tuple(value)
+        return value
+
+    @staticmethod
+    def _number_of_packages_cache_filter(grouping, grouping_filter):
+        filters = [None] * len(grouping)
+        for i, ids in enumerate(grouping_filter or []):
+            if ids is not None:
+                filters[i] = frozenset(ids)
+        return tuple(filters)
+
+    @classmethod
+    def _number_of_packages_shared_key(cls, key, locations, filters):
+        '''
+        Return the key of the shared cache or None if the result can not be
+        shared.
+
+        Only results up to an end date not after today without forecast nor
+        assigned moves are shared as they depend only on done moves.
+        '''
+        pool = Pool()
+        Date = pool.get('ir.date')
+        transaction = Transaction()
+        context = transaction.context
+        if (transaction in _number_of_packages_dirty
+                or context.get('forecast')
+                or context.get('stock_assign')):
+            return
+        today = Date.today()
+        date_end = context.get('stock_date_end')
+        if not date_end or date_end > today:
+            return
+        return (transaction.database.name, transaction.user, today,
+            key, locations, filters)
+
+    @classmethod
+    def clear_number_of_packages_cache(cls, done=False):
+        '''
+        Clear number of packages results memoized in the transaction.
+
+        The results shared between the processes are cleared when done is
+        set because moves reached or left the done state.
+        The memo is also cleared on commit and rollback, but it must be
+        called after writing moves with SQL in the transaction.
+        '''
+        transaction = Transaction()
+        _number_of_packages_cache.pop(transaction, None)
+        _number_of_packages_dirty[transaction] = True
+        transaction.join(_NumberOfPackagesCacheDataManager())
+        if done:
+            cls._number_of_packages_shared_cache.clear()
 
     def get_package_required(self, name):
         return self.template.package_required
@@ -79,3 +382,250 @@ class Product(StockMixin, metaclass=PoolMeta):
                 if quantity is not None:
                     quantities[key] = int(quantity)
         return quantities
+
+    @classmethod
+    def package_balance_grouping(cls):
+        "Return the grouping of the package balances"
+        Move = Pool().get('stock.move')
+        if hasattr(Move, 'lot'):
+            return ('product', 'lot', 'package')
+        return ('product', 'package')
+
+    @classmethod
+    def _package_balances_result(cls):
+        return {
+            'location': [],
+            'product': [],
+            'lot': [],
+            'package': [],
+            'number_of_packages': [],
+            'cursor': None,
+            }
+
+    @classmethod
+    def _append_package_balance(cls, result, grouping, row):
+        values = dict(zip(('location',) + grouping, row))
+        for name in ('location', 'product', 'lot', 'package'):
+            result[name].append(values.get(name) or None)
+        result['number_of_packages'].append(int(row[-1]))
+
+    @classmethod
+    def get_package_balances(cls, location_ids, after=None, limit=10000):
+        '''
+        Return the current number of packages of the locations by product,
+        lot and package as parallel lists ordered by product.
+
+        A page starts after the cursor of the previous one, the cursor of the
+        next page is returned or None for the last page.
+        The pages are read with a keyset on the aggregated keys, so the
+        products without stock are not computed. When the stock starts from
+        an archived period cache, the balances are computed with it and
+        paged in memory.
+        '''
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Move = pool.get('stock.move')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        grouping = cls.package_balance_grouping()
+        result = cls._package_balances_result()
+        if not location_ids:
+            return result
+
+        # Null values are ordered as 0 to get a total order for the cursor
+        def sort_key(row):
+            return (row[1], row[0]) + tuple(row[2:-1])
+        with transaction.set_context(
+                stock_date_end=Date.today(),
+                number_of_packages=True):
+            if cls._archived_period(grouping):
+                quantities = cls._products_by_location(location_ids,
+                    grouping=grouping)
+                rows = sorted(((k[0],) + tuple(v or 0 for v in k[1:]) + (q,)
+                        for k, q in quantities.items() if q),
+                    key=sort_key)
+                if after:
+                    rows = [r for r in rows if sort_key(r) > tuple(after)]
+                rows = rows[:limit]
+            else:
+                query = Move.compute_quantities_query(location_ids,
+                    grouping=grouping)
+                columns = [query.location] + [
+                    Coalesce(Column(query, g), 0) for g in grouping]
+                keys = [columns[1], columns[0]] + columns[2:]
+                where = query.quantity != 0
+                if after:
+                    condition = Literal(False)
+                    for key, value in reversed(list(zip(keys, after))):
+                        condition = (key > value) | (
+                            (key == value) & condition)
+                    where &= condition
+                cursor.execute(*query.select(*(columns + [query.quantity]),
+                        where=where, order_by=keys, limit=limit))
+                rows = cursor.fetchall()
+
+        for row in rows:
+            cls._append_package_balance(result, grouping, row)
+        if len(rows) == limit:
+            result['cursor'] = list(sort_key(rows[-1]))
+        return result
+
+    @classmethod
+    def get_package_balance_changes(cls, location_ids, after=None,
+            limit=1000):
+        '''
+        Return the net change of the number of packages of the keys of the
+        locations after the cursor as parallel lists.
+
+        The changes are summed from the package deltas recorded when moves
+        reach, leave or are changed in the done state. The cursor is the
+        create date and the id of the last delta read.
+        The deltas created in the last stock_number_of_packages/
+        change_feed_delay seconds are left for the next call, so the delay
+        must be longer than the transactions writing moves.
+        '''
+        pool = Pool()
+        PackageDelta = pool.get('stock.move.package_delta')
+        delta = PackageDelta.__table__()
+        cursor = Transaction().connection.cursor()
+
+        grouping = cls.package_balance_grouping()
+        result = cls._package_balances_result()
+        result['cursor'] = after
+
+        delay = config.getint('stock_number_of_packages',
+            'change_feed_delay', default=5)
+        until = datetime.datetime.now() - datetime.timedelta(seconds=delay)
+        where = (delta.location.in_(location_ids)
+            & (delta.create_date <= until))
+        if after:
+            after_date, after_id = after
+            where &= ((delta.create_date > after_date)
+                | ((delta.create_date == after_date)
+                    & (delta.id > after_id)))
+        cursor.execute(*delta.select(delta.create_date, delta.id,
+                delta.location, *[Column(delta, g) for g in grouping],
+                delta.number_of_packages,
+                where=where, order_by=[delta.create_date, delta.id],
+                limit=limit))
+
+        changes = defaultdict(int)
+        row = None
+        for row in cursor:
+            changes[tuple(row[2:-1])] += row[-1]
+        if row is None:
+            return result
+        result['cursor'] = [row[0], row[1]]
+
+        for key in sorted(changes, key=lambda k: tuple(v or 0 for v in k)):
+            if changes[key]:
+                cls._append_package_balance(result, grouping,
+                    key + (changes[key],))
+        return result
+
+    @classmethod
+    def packages_by_date(cls, location_ids, dates, grouping=('product',),
+            grouping_filter=None):
+        '''
+        Return for each date a dictionary with the number of packages of the
+        done moves by location and grouping, like products_by_location.
+
+        All the dates are computed with a single query of cumulative sums
+        of the moves after the latest closed period before the first date,
+        whose cache is used as starting balance.
+        '''
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Period = pool.get('stock.period')
+        move = Move.__table__()
+        cursor = Transaction().connection.cursor()
+        company = Transaction().context.get('company')
+
+        grouping = tuple(grouping)
+        dates = sorted(set(dates))
+        result = {d: {} for d in dates}
+        if not dates or not location_ids:
+            return result
+
+        def filter_where(table):
+            where = Literal(True)
+            for fname, ids in zip(grouping, grouping_filter or []):
+                if ids is not None:
+                    where &= Column(table, fname).in_(ids)
+            return where
+
+        balances = {}
+        period = None
+        Cache = (Period.get_cache(grouping)
+            if grouping in Period.groupings() else None)
+        if Cache:
+            domain = [
+                ('state', '=', 'closed'),
+                ('date', '<', dates[0]),
+                ]
+            if company:
+                domain.append(('company', '=', company))
+            periods = Period.search(domain, order=[('date', 'DESC')],
+                limit=1)
+            if periods and periods[0].caches_archived:
+                period, = periods
+                balances = Period.read_archived_cache(period, grouping,
+                    location_ids, grouping_filter=grouping_filter,
+                    quantity_field='number_of_packages')
+            elif periods:
+                period, = periods
+                cache = Cache.__table__()
+                cursor.execute(*cache.select(cache.location,
+                        *[Column(cache, g) for g in grouping],
+                        cache.number_of_packages,
+                        where=(cache.period == period.id)
+                        & cache.location.in_(location_ids)
+                        & filter_where(cache)))
+                for row in cursor:
+                    balances[tuple(row[:-1])] = row[-1] or 0
+
+        date = Coalesce(move.effective_date, move.planned_date)
+        where = ((move.state == 'done') & (date <= dates[-1])
+            & filter_where(move))
+        if period:
+            where &= date > period.date
+        if company:
+            where &= move.company == company
+        number_of_packages = Coalesce(move.number_of_packages, 0)
+        columns = [Column(move, g).as_(g) for g in grouping]
+        moves = Union(
+            move.select(move.to_location.as_('location'), *columns,
+                date.as_('date'), number_of_packages.as_('delta'),
+                where=where & move.to_location.in_(location_ids)),
+            move.select(move.from_location.as_('location'), *columns,
+                date.as_('date'), (-number_of_packages).as_('delta'),
+                where=where & move.from_location.in_(location_ids)),
+            all_=True)
+        keys = [moves.location] + [Column(moves, g) for g in grouping]
+        daily = moves.select(*keys, moves.date,
+            Sum(moves.delta).as_('delta'),
+            group_by=keys + [moves.date])
+        keys = [daily.location] + [Column(daily, g) for g in grouping]
+        cursor.execute(*daily.select(*keys, daily.date,
+                Sum(daily.delta,
+                    window=Window(keys, order_by=[daily.date.asc])),
+                order_by=[k.asc for k in keys] + [daily.date.asc]))
+
+        def add(key, points):
+            balance = balances.pop(key, 0)
+            cumulative, points = 0, iter(points)
+            point = next(points, None)
+            for date in dates:
+                while point is not None and point[0] <= date:
+                    cumulative = point[1]
+                    point = next(points, None)
+                if balance + cumulative:
+                    result[date][key] = int(balance + cumulative)
+
+        size = len(grouping) + 1
+        for key, rows in groupby(cursor, key=lambda r: tuple(r[:size])):
+            add(key, [r[size:] for r in rows])
+        for key in list(balances):
+            add(key, [])
+        return result
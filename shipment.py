@@ -1,14 +1,113 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
-from trytond.pool import PoolMeta
+from sql import Literal, Null
+from sql.aggregate import Sum
+from sql.conditionals import Case, Coalesce, NullIf
+from trytond.model import fields
+from trytond.pool import Pool, PoolMeta
+from trytond.rpc import RPC
+from trytond.tools import grouped_slice
 from trytond.transaction import Transaction
+from trytond.exceptions import UserError
+from trytond.i18n import gettext
 
-__all__ = ['ShipmentIn', 'ShipmentOut', 'ShipmentOutReturn']
+__all__ = ['ShipmentIn', 'ShipmentInLot', 'ShipmentOut', 'ShipmentOutReturn']
 
 
-class ShipmentIn(metaclass=PoolMeta):
+class PackagesWeightMixin(object):
+    packages_weight = fields.Function(fields.Float('Packages Net Weight',
+            help='The net weight of the packages of the lots.'),
+        'get_packages_weight')
+    packages_gross_weight = fields.Function(
+        fields.Float('Packages Gross Weight',
+            help='The net weight with the weight of the packages and of the '
+            'pallets.'),
+        'get_packages_weight')
+
+    @classmethod
+    def _packages_weight_location(cls, move):
+        "Return the location column and type of the weighted moves"
+        raise NotImplementedError
+
+    @classmethod
+    def get_packages_weight(cls, shipments, names):
+        '''
+        Return the net and gross weight of the packages of the shipments.
+
+        The net weight is the number of packages by the weight by package of
+        the lot, so it is only known for the moves with a lot. The gross
+        weight adds the weight of the packages and the share of the pallet
+        weight of the moved packages, from the lot or the packaging.
+        '''
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        Move = pool.get('stock.move')
+        Location = pool.get('stock.location')
+        Package = pool.get('product.pack')
+        Uom = pool.get('product.uom')
+        move = Move.__table__()
+        location = Location.__table__()
+        package = Package.__table__()
+        cursor = Transaction().connection.cursor()
+
+        kg = Uom(ModelData.get_id('product', 'uom_kilogram'))
+        number_of_packages = Coalesce(move.number_of_packages, 0)
+        location_column, location_type = cls._packages_weight_location(move)
+        query = move.join(location,
+            condition=location_column == location.id
+            ).join(package, 'LEFT', condition=move.package == package.id)
+        net_weight = Literal(0.)
+        package_weight = Coalesce(package.weight, 0.)
+        # The packages of a pallet are the layers of the packaging
+        pallet_weight = Coalesce(
+            Coalesce(package.pallet_weight, 0.) * number_of_packages
+            / NullIf(package.layers * package.packages_layer, 0), 0.)
+        if hasattr(Move, 'lot'):
+            Lot = pool.get('stock.lot')
+            lot = Lot.__table__()
+            query = query.join(lot, 'LEFT', condition=move.lot == lot.id)
+            net_weight = Coalesce(lot.weight_by_package, 0.)
+            package_weight = Case((lot.id != Null,
+                    Coalesce(lot.package_weight, 0.)),
+                else_=package_weight)
+            # A lot is a pallet
+            pallet_weight = Case((lot.id != Null,
+                    Coalesce(Coalesce(lot.pallet_weight, 0.)
+                        * number_of_packages
+                        / NullIf(lot.initial_number_of_packages, 0), 0.)),
+                else_=pallet_weight)
+
+        weights = {s.id: (0., 0.) for s in shipments}
+        for sub_shipments in grouped_slice(shipments):
+            references = ['%s,%s' % (cls.__name__, s.id)
+                for s in sub_shipments]
+            cursor.execute(*query.select(move.shipment,
+                    Sum(number_of_packages * net_weight),
+                    Sum(number_of_packages * (net_weight + package_weight)
+                        + pallet_weight),
+                    where=move.shipment.in_(references)
+                    & (location.type == location_type)
+                    & (move.state != 'cancel'),
+                    group_by=[move.shipment]))
+            for shipment, net, gross in cursor:
+                _, shipment_id = shipment.split(',')
+                weights[int(shipment_id)] = (net or 0., gross or 0.)
+
+        result = {}
+        for name in names:
+            index = 0 if name == 'packages_weight' else 1
+            result[name] = {i: kg.round(w[index])
+                for i, w in weights.items()}
+        return result
+
+
+class ShipmentIn(PackagesWeightMixin, metaclass=PoolMeta):
     __name__ = 'stock.shipment.in'
 
+    @classmethod
+    def _packages_weight_location(cls, move):
+        return move.from_location, 'supplier'
+
     def _get_inventory_move(self, incoming_move):
         move = super(ShipmentIn, self)._get_inventory_move(incoming_move)
         if not move:
@@ -18,9 +117,100 @@ class ShipmentIn(metaclass=PoolMeta):
         return move
 
 
-class ShipmentOut(metaclass=PoolMeta):
+class ShipmentInLot(metaclass=PoolMeta):
+    __name__ = 'stock.shipment.in'
+
+    @classmethod
+    def __setup__(cls):
+        super(ShipmentInLot, cls).__setup__()
+        cls.__rpc__.update({
+                'receive_pallets': RPC(readonly=False, instantiate=0),
+                })
+
+    @classmethod
+    def receive_pallets(cls, shipment, pallets):
+        '''
+        Create the lots and the incoming moves of the pallets received by
+        the shipment and return the moves.
+
+        Each pallet is a dictionary with the product, the lot number and
+        optionally the package, which defaults to the product one, and the
+        number of packages, which defaults to the layers of the package.
+        '''
+        pool = Pool()
+        Lot = pool.get('stock.lot')
+        Move = pool.get('stock.move')
+        Package = pool.get('product.pack')
+        Product = pool.get('product.product')
+
+        if shipment.state != 'draft':
+            raise UserError(gettext(
+                    'stock_number_of_packages.receive_pallets_not_draft',
+                    shipment=shipment.rec_name))
+
+        products = {p.id: p for p in Product.browse(
+                list({int(p['product']) for p in pallets}))}
+        package_ids = []
+        for pallet in pallets:
+            package = pallet.get('package')
+            if package is None:
+                package = products[int(pallet['product'])].default_package
+            package_ids.append(int(package) if package is not None else None)
+        packages = {p.id: p for p in Package.browse(
+                list({i for i in package_ids if i is not None}))}
+
+        lot_vlist = []
+        for pallet, package_id in zip(pallets, package_ids):
+            values = {
+                'number': pallet['number'],
+                'product': int(pallet['product']),
+                'package': package_id,
+                }
+            if package_id is not None:
+                values.update(Lot.get_package_values(packages[package_id]))
+            if pallet.get('number_of_packages') is not None:
+                values['initial_number_of_packages'] = (
+                    pallet['number_of_packages'])
+            lot_vlist.append(values)
+
+        # The quantity by package of the new lots is the package one
+        numbers = [v.get('initial_number_of_packages') for v in lot_vlist]
+        quantities = Package.compute_quantities(
+            [v['product'] for v in lot_vlist], [None] * len(lot_vlist),
+            package_ids, numbers)
+        for values, quantity in zip(lot_vlist, quantities):
+            values['total_qty'] = quantity
+        lots = Lot.create(lot_vlist)
+
+        move_vlist = []
+        for lot, package_id, number, quantity in zip(
+                lots, package_ids, numbers, quantities):
+            product = products[lot.product.id]
+            move_vlist.append({
+                    'shipment': str(shipment),
+                    'product': product.id,
+                    'uom': product.default_uom.id,
+                    'quantity': quantity or 0.,
+                    'lot': lot.id,
+                    'package': package_id,
+                    'number_of_packages': number,
+                    'from_location': shipment.supplier_location.id,
+                    'to_location': shipment.warehouse_input.id,
+                    'planned_date': shipment.planned_date,
+                    'company': shipment.company.id,
+                    'unit_price': product.cost_price,
+                    'currency': shipment.company.currency.id,
+                    })
+        return Move.create(move_vlist)
+
+
+class ShipmentOut(PackagesWeightMixin, metaclass=PoolMeta):
     __name__ = 'stock.shipment.out'
 
+    @classmethod
+    def _packages_weight_location(cls, move):
+        return move.to_location, 'customer'
+
     def _get_inventory_move(self, move):
         inventory_move = super(ShipmentOut, self)._get_inventory_move(move)
         if not inventory_move:
@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+'''
+Load test of the packaged move and inventory workflows.
+
+Many simulated clients run concurrently the workflows of the module against
+a database where it is installed:
+
+    python load_stock_number_of_packages.py -c trytond.conf -d load \\
+        --clients 20 --duration 60
+
+It reports the throughput and latency percentiles of each workflow, the
+retries on operational errors, the deadlocks and the sessions waiting for
+locks sampled in pg_stat_activity.
+'''
+import argparse
+import datetime
+import random
+import threading
+import time
+from collections import defaultdict
+from decimal import Decimal
+
+WORKFLOWS = {
+    'move_do': 4,
+    'inventory_line': 3,
+    'complete_inventory': 1,
+    'packaging_write': 2,
+    }
+
+
+class Stats(object):
+    "Thread safe collection of the results of the workflows"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.retries = defaultdict(int)
+        self.deadlocks = 0
+        self.lock_waits = []
+
+    def add(self, workflow, latency):
+        with self.lock:
+            self.latencies[workflow].append(latency)
+
+    def error(self, workflow, exception):
+        with self.lock:
+            self.errors[(workflow, exception.__class__.__name__)] += 1
+
+    def retry(self, workflow, exception):
+        with self.lock:
+            self.retries[workflow] += 1
+            if 'deadlock' in str(exception):
+                self.deadlocks += 1
+
+
+def percentile(values, percent):
+    if not values:
+        return 0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(percent / 100 * len(values))))
+    return values[index]
+
+
+def run_transaction(database, user, context, function, retries=5):
+    '''
+    Run function in a new transaction and commit it.
+
+    The transaction is retried on operational errors like the dispatcher of
+    trytond does, the retries are returned.
+    '''
+    from trytond import backend
+    from trytond.transaction import Transaction
+    DatabaseOperationalError = backend.get('DatabaseOperationalError')
+
+    errors = []
+    while True:
+        try:
+            with Transaction().start(database, user,
+                    context=context) as transaction:
+                function()
+                transaction.commit()
+            return errors
+        except DatabaseOperationalError as exception:
+            if len(errors) >= retries:
+                raise
+            errors.append(exception)
+            time.sleep(random.uniform(0, 0.1 * 2 ** len(errors)))
+
+
+def setup(database, products):
+    '''
+    Create the products with packaging and their initial stock.
+
+    Return the user, its context and the ids used by the workflows.
+    '''
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+
+    data = {}
+    with Transaction().start(database, 0) as transaction:
+        pool = Pool()
+        User = pool.get('res.user')
+        admin, = User.search([('login', '=', 'admin')])
+        data['user'] = admin.id
+        # The preferences are those of the user, not of root
+        with transaction.set_user(admin.id):
+            data['context'] = User.get_preferences(context_only=True)
+        transaction.commit()
+
+    def create():
+        pool = Pool()
+        Company = pool.get('company.company')
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        Template = pool.get('product.template')
+        Uom = pool.get('product.uom')
+
+        company = Company(Transaction().context['company'])
+        supplier, = Location.search([('code', '=', 'SUP')])
+        storage, = Location.search([('code', '=', 'STO')])
+        customer, = Location.search([('code', '=', 'CUS')])
+        unit, = Uom.search([('name', '=', 'Unit')])
+        templates = Template.create([{
+                    'name': 'Load Product %s' % i,
+                    'type': 'goods',
+                    'list_price': Decimal(1),
+                    'default_uom': unit.id,
+                    'package_required': True,
+                    'packagings': [('create', [{
+                                    'name': 'Box',
+                                    'qty': 10,
+                                    }])],
+                    'products': [('create', [{}])],
+                    } for i in range(products)])
+        Template.write(*[a for t in templates for a in (
+                    [t], {'default_package': t.packagings[0].id})])
+        items = [(t.products[0].id, t.packagings[0].id) for t in templates]
+        moves = Move.create([{
+                    'product': product_id,
+                    'uom': unit.id,
+                    'package': package_id,
+                    'number_of_packages': 100,
+                    'quantity': 1000,
+                    'from_location': supplier.id,
+                    'to_location': storage.id,
+                    'effective_date': datetime.date.today(),
+                    'company': company.id,
+                    'unit_price': Decimal(1),
+                    'currency': company.currency.id,
+                    } for product_id, package_id in items])
+        Move.do(moves)
+        data.update({
+                'company': company.id,
+                'currency': company.currency.id,
+                'unit': unit.id,
+                'supplier': supplier.id,
+                'storage': storage.id,
+                'customer': customer.id,
+                'items': items,
+                })
+    run_transaction(database, data['user'], data['context'], create)
+    return data
+
+
+def move_do(data):
+    "Receive or send packages, validated by Move.do"
+    from trytond.pool import Pool
+    Move = Pool().get('stock.move')
+
+    from_location, to_location = random.choice([
+            (data['supplier'], data['storage']),
+            (data['storage'], data['customer']),
+            ])
+    moves = Move.create([{
+                'product': product_id,
+                'uom': data['unit'],
+                'package': package_id,
+                'number_of_packages': 1,
+                'quantity': 10,
+                'from_location': from_location,
+                'to_location': to_location,
+                'effective_date': datetime.date.today(),
+                'company': data['company'],
+                'unit_price': Decimal(1),
+                'currency': data['currency'],
+                } for product_id, package_id in random.sample(
+                data['items'], min(5, len(data['items'])))])
+    Move.do(moves)
+
+
+def inventory_line(data):
+    "Edit inventory lines computing their expected number of packages"
+    from trytond.pool import Pool
+    pool = Pool()
+    Inventory = pool.get('stock.inventory')
+    Line = pool.get('stock.inventory.line')
+
+    inventory = Inventory(location=data['storage'],
+        date=datetime.date.today(), company=data['company'])
+    inventory.save()
+    lines = []
+    for product_id, package_id in random.sample(
+            data['items'], min(5, len(data['items']))):
+        line = Line(inventory=inventory, product=product_id,
+            package=package_id, number_of_packages=1, quantity=10)
+        line.expected_number_of_packages = (
+            line.on_change_with_expected_number_of_packages())
+        lines.append(line)
+    Line.save(lines)
+
+
+def complete_inventory(data):
+    "Complete a cycle count inventory of some products"
+    from trytond.pool import Pool
+    pool = Pool()
+    Inventory = pool.get('stock.inventory')
+
+    inventory, = Inventory.create([{
+                'location': data['storage'],
+                'date': datetime.date.today(),
+                'company': data['company'],
+                'cycle_count': True,
+                'lines': [('create', [{
+                                'product': product_id,
+                                'package': package_id,
+                                'number_of_packages': 1,
+                                'quantity': 10,
+                                } for product_id, package_id in random.sample(
+                                data['items'], min(20, len(data['items'])))
+                            ])],
+                }])
+    Inventory.complete_lines([inventory])
+
+
+def packaging_write(data):
+    "Write packagings checking they have no move"
+    from trytond.exceptions import UserError
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+    Package = Pool().get('product.pack')
+
+    packages = Package.browse([package_id
+            for _, package_id in random.sample(
+                data['items'], min(5, len(data['items'])))])
+    with Transaction().set_context(_check_access=True):
+        Package.write(*[a for p in packages for a in (
+                    [p], {'qty': p.qty})])
+    try:
+        Package.check_no_move(packages,
+            'stock_number_of_packages.delete_packaging')
+    except UserError:
+        pass
+
+
+def client(database, data, workflows, deadline, stats):
+    functions = [globals()[w] for w in workflows]
+    weights = [WORKFLOWS[w] for w in workflows]
+    while time.monotonic() < deadline:
+        function, = random.choices(functions, weights)
+        start = time.perf_counter()
+        try:
+            retries = run_transaction(database, data['user'],
+                data['context'], lambda: function(data))
+        except Exception as exception:
+            stats.error(function.__name__, exception)
+            continue
+        for exception in retries:
+            stats.retry(function.__name__, exception)
+        stats.add(function.__name__, time.perf_counter() - start)
+
+
+def monitor(database, stop, stats, interval=1):
+    "Sample the sessions of the database waiting for a lock"
+    from trytond.transaction import Transaction
+
+    with Transaction().start(database, 0, readonly=True) as transaction:
+        cursor = transaction.connection.cursor()
+        while not stop.wait(interval):
+            cursor.execute('SELECT COUNT(*) FROM pg_stat_activity '
+                'WHERE datname = %s AND wait_event_type = %s',
+                (database, 'Lock'))
+            count, = cursor.fetchone()
+            with stats.lock:
+                stats.lock_waits.append(count)
+            # End the snapshot so the next sample is up to date
+            transaction.connection.rollback()
+
+
+def database_deadlocks(database):
+    from trytond.transaction import Transaction
+
+    with Transaction().start(database, 0, readonly=True) as transaction:
+        cursor = transaction.connection.cursor()
+        cursor.execute('SELECT deadlocks FROM pg_stat_database '
+            'WHERE datname = %s', (database,))
+        deadlocks, = cursor.fetchone()
+    return deadlocks
+
+
+def report(stats, elapsed, deadlocks):
+    print('%-20s %8s %8s %8s %8s %8s %8s' % (
+            'workflow', 'count', 'tps', 'p50 ms', 'p95 ms', 'p99 ms',
+            'retries'))
+    for workflow in sorted(stats.latencies):
+        latencies = stats.latencies[workflow]
+        print('%-20s %8d %8.2f %8.1f %8.1f %8.1f %8d' % (
+                workflow, len(latencies), len(latencies) / elapsed,
+                percentile(latencies, 50) * 1000,
+                percentile(latencies, 95) * 1000,
+                percentile(latencies, 99) * 1000,
+                stats.retries[workflow]))
+    total = sum(len(l) for l in stats.latencies.values())
+    print('throughput: %.2f transactions/s' % (total / elapsed))
+    print('deadlocks: %d detected by clients, %d by the database' % (
+            stats.deadlocks, deadlocks))
+    if stats.lock_waits:
+        print('lock waits: %.2f sessions on average, %d at most' % (
+                sum(stats.lock_waits) / len(stats.lock_waits),
+                max(stats.lock_waits)))
+    for (workflow, error), count in sorted(stats.errors.items()):
+        print('error: %s %s %d' % (workflow, error, count))
+
+
+def main(database, clients, duration, products, workflows):
+    from trytond.pool import Pool
+
+    Pool.start()
+    Pool(database).init()
+
+    data = setup(database, products)
+    deadlocks = database_deadlocks(database)
+    stats = Stats()
+    stop = threading.Event()
+    monitor_thread = threading.Thread(target=monitor,
+        args=(database, stop, stats))
+    monitor_thread.start()
+
+    start = time.monotonic()
+    threads = [threading.Thread(target=client,
+            args=(database, data, workflows, start + duration, stats))
+        for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+    stop.set()
+    monitor_thread.join()
+
+    report(stats, elapsed, database_deadlocks(database) - deadlocks)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-c', '--config', dest='config',
+        help='trytond configuration file')
+    parser.add_argument('-d', '--database', dest='database', required=True,
+        help='database with the module installed')
+    parser.add_argument('--clients', type=int, default=10,
+        help='number of concurrent clients')
+    parser.add_argument('--duration', type=int, default=60,
+        help='duration of the test in seconds')
+    parser.add_argument('--products', type=int, default=50,
+        help='number of products created for the test')
+    parser.add_argument('--workflow', dest='workflows', action='append',
+        choices=sorted(WORKFLOWS),
+        help='workflow to run, all by default')
+    options = parser.parse_args()
+
+    from trytond.config import config
+    config.update_etc(options.config)
+
+    main(options.database, options.clients, options.duration,
+        options.products, options.workflows or sorted(WORKFLOWS))
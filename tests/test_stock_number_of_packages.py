@@ -1,22 +1,1498 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import datetime
 import doctest
+import os
+import shutil
+import tempfile
 import unittest
+from decimal import Decimal
+from unittest.mock import patch
 import trytond.tests.test_tryton
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond.config import config
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.tests.test_tryton import activate_module, drop_db, DB_NAME
 from trytond.tests.test_tryton import doctest_setup, doctest_teardown
 from trytond.tests.test_tryton import doctest_checker
+from trytond.exceptions import UserError
+from trytond.pool import Pool
+from trytond.transaction import Transaction
 
+from trytond.modules.company.tests import create_company, set_company
 
-class StockNumberOfPackagesTestCase(ModuleTestCase):
+
+class _CountingCursor(object):
+    "Cursor proxy counting the executed queries"
+
+    def __init__(self, cursor, counter):
+        self._cursor = cursor
+        self._counter = counter
+
+    def execute(self, *args, **kwargs):
+        self._counter.count += 1
+        return self._cursor.execute(*args, **kwargs)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class _CountingConnection(object):
+    "Connection proxy returning counting cursors"
+
+    def __init__(self, connection, counter):
+        self._connection = connection
+        self._counter = counter
+
+    def cursor(self, *args, **kwargs):
+        return _CountingCursor(
+            self._connection.cursor(*args, **kwargs), self._counter)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+class QueryCounter(object):
+    "Count the queries executed on the connection of the transaction"
+
+    def __init__(self):
+        self.count = 0
+
+    def __enter__(self):
+        transaction = Transaction()
+        self._connection = transaction.connection
+        transaction.connection = _CountingConnection(self._connection, self)
+        return self
+
+    def __exit__(self, *args):
+        Transaction().connection = self._connection
+
+
+class PackagesTestMixin(object):
+    "Helpers to create packaged products and moves"
+
+    def assertQueryBudget(self, prepare, execute, size=5, factor=10):
+        '''
+        Assert the number of queries of execute does not grow with the
+        number of records returned by prepare.
+        '''
+        # Warm up the caches
+        execute(prepare(1))
+        counts = []
+        for count in (size, size * factor):
+            records = prepare(count)
+            with QueryCounter() as counter:
+                execute(records)
+            counts.append(counter.count)
+        self.assertLessEqual(counts[1], counts[0],
+            msg='%s queries for %s records but %s for %s' % (
+                counts[1], size * factor, counts[0], size))
+
+    @classmethod
+    def create_products(cls, count=1, qty=10):
+        pool = Pool()
+        Template = pool.get('product.template')
+        Uom = pool.get('product.uom')
+
+        unit, = Uom.search([('name', '=', 'Unit')])
+        templates = Template.create([{
+                    'name': 'Product %s' % i,
+                    'type': 'goods',
+                    'list_price': Decimal(1),
+                    'default_uom': unit.id,
+                    'packagings': [('create', [{
+                                    'name': 'Package',
+                                    'qty': qty,
+                                    }])],
+                    'products': [('create', [{}])],
+                    } for i in range(count)])
+        to_write = []
+        for template in templates:
+            package, = template.packagings
+            to_write.extend(([template], {
+                        'package_required': True,
+                        'default_package': package.id,
+                        }))
+        Template.write(*to_write)
+        return [(t.products[0], t.packagings[0]) for t in templates]
+
+    def create_product(self, qty=10):
+        (product, package), = self.create_products(qty=qty)
+        return product, package
+
+    @classmethod
+    def create_moves(cls, company, product, package, from_location,
+            to_location, date, count=1, number_of_packages=1, lot=None):
+        pool = Pool()
+        Move = pool.get('stock.move')
+        values = {
+            'product': product.id,
+            'uom': product.default_uom.id,
+            'package': package.id,
+            'number_of_packages': number_of_packages,
+            'quantity': number_of_packages * (
+                lot.package_qty if lot else package.qty),
+            'from_location': from_location.id,
+            'to_location': to_location.id,
+            'effective_date': date,
+            'company': company.id,
+            'unit_price': Decimal(1),
+            'currency': company.currency.id,
+            }
+        if lot:
+            values['lot'] = lot.id
+        return Move.create([values.copy() for _ in range(count)])
+
+    @classmethod
+    def create_parallel_stock(cls, company):
+        "Create products in two locations and return them"
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+
+        supplier, = Location.search([('code', '=', 'SUP')])
+        locations = Location.create([{
+                    'name': 'Parallel %s' % i,
+                    'type': 'storage',
+                    } for i in range(2)])
+        products = cls.create_products(2)
+        for i, location in enumerate(locations, 1):
+            for product, package in products:
+                Move.do(cls.create_moves(company, product, package,
+                        supplier, location, Date.today(),
+                        number_of_packages=i))
+        return locations, [p for p, _ in products]
+
+    def products_by_location_parallel(self, locations, products):
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Product = pool.get('product.product')
+        with Transaction().set_context(stock_date_end=Date.today(),
+                number_of_packages=True):
+            sequential = Product.products_by_location(
+                [l.id for l in locations],
+                grouping_filter=([p.id for p in products],))
+            Product.clear_number_of_packages_cache()
+            parallel = Product.products_by_location_parallel(
+                [l.id for l in locations],
+                grouping_filter=([p.id for p in products],))
+        return sequential, parallel
+
+
+class StockNumberOfPackagesTestCase(PackagesTestMixin, ModuleTestCase):
     'Test Stock Number of Packages module'
     module = 'stock_number_of_packages'
 
+    @with_transaction()
+    def test_products_by_location_memoize(self):
+        'Test number of packages results are memoized in the transaction'
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        Product = pool.get('product.product')
+        transaction = Transaction()
+
+        company = create_company()
+        with set_company(company):
+            (product, package), (other, other_package) = (
+                self.create_products(2))
+            supplier, = Location.search([('code', '=', 'SUP')])
+            storage, = Location.search([('code', '=', 'STO')])
+            today = Date.today()
+            Move.do(self.create_moves(company, product, package,
+                    supplier, storage, today, number_of_packages=2))
+            Move.do(self.create_moves(company, other, other_package,
+                    supplier, storage, today, number_of_packages=3))
+
+            def number_of_packages(location_ids, product_ids):
+                with transaction.set_context(stock_date_end=today,
+                        number_of_packages=True):
+                    return Product.products_by_location(location_ids,
+                        grouping_filter=(product_ids,))
+
+            quantities = number_of_packages([storage.id, supplier.id],
+                [product.id, other.id])
+            self.assertEqual(quantities[(storage.id, product.id)], 2)
+            self.assertEqual(quantities[(storage.id, other.id)], 3)
+
+            # A subset of the locations and products is read from the memo
+            with QueryCounter() as counter:
+                quantities = number_of_packages([storage.id], [product.id])
+            self.assertEqual(counter.count, 0)
+            self.assertEqual(quantities, {(storage.id, product.id): 2})
+
+            # Another user does not share the memo
+            with transaction.set_user(0), QueryCounter() as counter:
+                number_of_packages([storage.id], [product.id])
+            self.assertGreater(counter.count, 0)
+
+            # Writing moves clears the memo
+            moves = self.create_moves(company, product, package,
+                supplier, storage, today)
+            Move.write(moves, {'number_of_packages': 1})
+            Move.do(moves)
+            self.assertEqual(number_of_packages([storage.id], [product.id]),
+                {(storage.id, product.id): 3})
+
+    @with_transaction()
+    def test_number_of_packages_shared_key(self):
+        'Test only results of done moves are shared between processes'
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Product = pool.get('product.product')
+
+        today = Date.today()
+
+        def shared_key(**context):
+            with Transaction().set_context(**context):
+                return Product._number_of_packages_shared_key(
+                    (True, ('product',)), (), ())
+
+        self.assertIsNone(shared_key(stock_date_end=None))
+        self.assertIsNotNone(shared_key(stock_date_end=today))
+        self.assertIsNotNone(shared_key(
+                stock_date_end=today - datetime.timedelta(days=1)))
+        self.assertIsNone(shared_key(
+                stock_date_end=today + datetime.timedelta(days=1)))
+        self.assertIsNone(shared_key(stock_date_end=today, forecast=True))
+        self.assertIsNone(shared_key(stock_date_end=today, stock_assign=True))
+
+    @with_transaction()
+    def test_number_of_packages_cache_rollback(self):
+        'Test number of packages memo is cleared on rollback'
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        Product = pool.get('product.product')
+        transaction = Transaction()
+
+        company = create_company()
+        with set_company(company):
+            product, package = self.create_product()
+            supplier, = Location.search([('code', '=', 'SUP')])
+            storage, = Location.search([('code', '=', 'STO')])
+            today = Date.today()
+            Move.do(self.create_moves(company, product, package,
+                    supplier, storage, today, number_of_packages=2))
+
+            def number_of_packages():
+                with transaction.set_context(stock_date_end=today,
+                        number_of_packages=True):
+                    quantities = Product.products_by_location([storage.id],
+                        grouping=('product', 'package'),
+                        grouping_filter=([product.id],))
+                return quantities.get((storage.id, product.id, package.id))
+
+            self.assertEqual(number_of_packages(), 2)
+            transaction.rollback()
+            self.assertFalse(number_of_packages())
+
+    @with_transaction()
+    def test_number_of_packages_shared_cache_clear(self):
+        'Test shared results are cleared only when done balances change'
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        Package = pool.get('product.pack')
+        Product = pool.get('product.product')
+
+        company = create_company()
+        with set_company(company):
+            product, package = self.create_product()
+            other_package, = Package.create([{
+                        'name': 'Other Package',
+                        'product': product.template.id,
+                        'qty': package.qty,
+                        }])
+            supplier, = Location.search([('code', '=', 'SUP')])
+            storage, = Location.search([('code', '=', 'STO')])
+            moves = self.create_moves(company, product, package,
+                supplier, storage, Date.today())
+            Move.do(moves)
+
+            with patch.object(Product,
+                    'clear_number_of_packages_cache') as clear:
+                Move.write(moves, {'unit_price': Decimal(2)})
+                clear.assert_called_once_with(done=False)
+                clear.reset_mock()
+                Move.write(moves, {'package': other_package.id})
+                clear.assert_called_once_with(done=True)
+
+    @with_transaction()
+    def test_get_package_balances(self):
+        'Test package balances are current and paged by key'
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        Product = pool.get('product.product')
+
+        company = create_company()
+        with set_company(company):
+            products = self.create_products(3)
+            supplier, = Location.search([('code', '=', 'SUP')])
+            storage, = Location.search([('code', '=', 'STO')])
+            today = Date.today()
+            for i, (product, package) in enumerate(products, 1):
+                Move.do(self.create_moves(company, product, package,
+                        supplier, storage, today, number_of_packages=i))
+            # Future moves are not in the current balance
+            product, package = products[0]
+            self.create_moves(company, product, package, supplier, storage,
+                today + datetime.timedelta(days=1), number_of_packages=5)
+
+            balances = {}
+            after, pages = None, 0
+            while True:
+                result = Product.get_package_balances([storage.id],
+                    after=after, limit=2)
+                pages += 1
+                for location, product, package, number in zip(
+                        result['location'], result['product'],
+                        result['package'], result['number_of_packages']):
+                    self.assertEqual(location, storage.id)
+                    balances[(product, package)] = number
+                after = result['cursor']
+                if not after:
+                    break
+            self.assertEqual(pages, 2)
+            self.assertEqual(balances, {
+                    (product.id, package.id): i
+                    for i, (product, package) in enumerate(products, 1)})
+
+    @with_transaction()
+    def test_get_package_balance_changes(self):
+        'Test change feed of package balances'
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        Package = pool.get('product.pack')
+        PackageDelta = pool.get('stock.move.package_delta')
+        Product = pool.get('product.product')
+        delta_table = PackageDelta.__table__()
+        cursor = Transaction().connection.cursor()
+
+        def backdate(minutes):
+            timestamp = (datetime.datetime.now()
+                - datetime.timedelta(minutes=minutes))
+            cursor.execute(*delta_table.update(
+                    [delta_table.create_date], [timestamp]))
+
+        def changes(after):
+            result = Product.get_package_balance_changes([storage.id],
+                after=after)
+            return result['cursor'], {
+                (product, package): number
+                for product, package, number in zip(result['product'],
+                    result['package'], result['number_of_packages'])}
+
+        company = create_company()
+        with set_company(company):
+            product, package = self.create_product()
+            other_package, = Package.create([{
+                        'name': 'Other Package',
+                        'product': product.template.id,
+                        'qty': package.qty,
+                        }])
+            supplier, = Location.search([('code', '=', 'SUP')])
+            storage, = Location.search([('code', '=', 'STO')])
+            today = Date.today()
+            moves = self.create_moves(company, product, package,
+                supplier, storage, today, count=2, number_of_packages=2)
+            Move.do(moves)
+            backdate(60)
+
+            after, deltas = changes(None)
+            self.assertEqual(deltas, {(product.id, package.id): 4})
+            self.assertEqual(changes(after), (after, {}))
+
+            # The key of a done move is moved
+            Move.write([moves[0]], {'package': other_package.id})
+            # Only the fields of the balances are recorded
+            Move.write([moves[1]], {'unit_price': Decimal(2)})
+            backdate(30)
+            after, deltas = changes(after)
+            self.assertEqual(deltas, {
+                    (product.id, package.id): -2,
+                    (product.id, other_package.id): 2,
+                    })
+
+            # The deltas of the last seconds are left for the next call
+            Move.do(self.create_moves(company, product, package,
+                    supplier, storage, today))
+            self.assertEqual(changes(after), (after, {}))
+
+            PackageDelta.clean(days=0)
+            self.assertEqual(changes(None), (None, {}))
+
+    @with_transaction()
+    def test_products_by_location_parallel_fallback(self):
+        'Test parallel number of packages fall back in writable transaction'
+        company = create_company()
+        with set_company(company):
+            locations, products = self.create_parallel_stock(company)
+            with patch('trytond.modules.stock_number_of_packages.product.'
+                    'ThreadPoolExecutor', side_effect=AssertionError):
+                sequential, parallel = self.products_by_location_parallel(
+                    locations, products)
+            self.assertEqual(parallel, sequential)
+            self.assertEqual(
+                parallel[(locations[1].id, products[0].id)], 2)
+
+    @with_transaction()
+    def test_period_cache_number_of_packages(self):
+        'Test historical number of packages do not read closed moves'
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        Period = pool.get('stock.period')
+        Product = pool.get('product.product')
+        transaction = Transaction()
+
+        company = create_company()
+        with set_company(company):
+            product, package = self.create_product()
+            supplier, = Location.search([('code', '=', 'SUP')])
+            storage, = Location.search([('code', '=', 'STO')])
+            today = Date.today()
+
+            closed_moves = self.create_moves(company, product, package,
+                supplier, storage, today - datetime.timedelta(days=10),
+                count=20)
+            Move.do(closed_moves)
+            period, = Period.create([{
+                        'date': today - datetime.timedelta(days=5),
+                        'company': company.id,
+                        }])
+            Period.close([period])
+            Move.do(self.create_moves(company, product, package,
+                    supplier, storage, today - datetime.timedelta(days=1),
+                    number_of_packages=2))
+
+            groupings = [('product',), ('product', 'package')]
+
+            def number_of_packages():
+                Product.clear_number_of_packages_cache()
+                with transaction.set_context(stock_date_end=today,
+                        number_of_packages=True):
+                    return [Product.products_by_location([storage.id],
+                            grouping=grouping,
+                            grouping_filter=([product.id],))
+                        for grouping in groupings]
+
+            quantities = number_of_packages()
+            self.assertEqual(quantities[0][(storage.id, product.id)], 22)
+            self.assertEqual(
+                quantities[1][(storage.id, product.id, package.id)], 22)
+
+            # The moves before the period must only be read from its cache
+            move = Move.__table__()
+            cursor = transaction.connection.cursor()
+            cursor.execute(*move.delete(
+                    where=move.id.in_([m.id for m in closed_moves])))
+            self.assertEqual(number_of_packages(), quantities)
+
+    @with_transaction()
+    def test_period_archive_caches(self):
+        'Test number of packages from archived period caches'
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        Period = pool.get('stock.period')
+        Product = pool.get('product.product')
+
+        company = create_company()
+        with set_company(company):
+            product, package = self.create_product()
+            supplier, = Location.search([('code', '=', 'SUP')])
+            storage, = Location.search([('code', '=', 'STO')])
+            today = Date.today()
+
+            for days, number_of_packages in [(10, 3), (6, 2), (1, 1)]:
+                Move.do(self.create_moves(company, product, package,
+                        supplier, storage,
+                        today - datetime.timedelta(days=days),
+                        number_of_packages=number_of_packages))
+            periods = Period.create([{
+                        'date': today - datetime.timedelta(days=days),
+                        'company': company.id,
+                        } for days in (8, 4)])
+            Period.close(periods)
+
+            def number_of_packages():
+                Product.clear_number_of_packages_cache()
+                result = []
+                for days in (8, 5, 0):
+                    with Transaction().set_context(
+                            stock_date_end=(
+                                today - datetime.timedelta(days=days)),
+                            number_of_packages=True):
+                        result.append(Product.products_by_location(
+                                [storage.id],
+                                grouping=('product', 'package'),
+                                grouping_filter=([product.id],)))
+                return result
+
+            quantities = number_of_packages()
+            directory = tempfile.TemporaryDirectory()
+            self.addCleanup(directory.cleanup)
+            if not config.has_section('stock_number_of_packages'):
+                config.add_section('stock_number_of_packages')
+            config.set('stock_number_of_packages', 'archive_path',
+                directory.name)
+            self.addCleanup(config.remove_option,
+                'stock_number_of_packages', 'archive_path')
+            # The latest closed period is read by the stock queries
+            Period.archive_caches([periods[1]])
+            self.assertFalse(Period(periods[1].id).caches_archived)
+            Period.archive_caches()
+            first, second = Period.browse([p.id for p in periods])
+            self.assertTrue(first.caches_archived)
+            self.assertFalse(first.package_caches)
+            self.assertFalse(second.caches_archived)
+            self.assertTrue(os.listdir(directory.name))
+            self.assertEqual(number_of_packages(), quantities)
+            key = (storage.id, product.id, package.id)
+            self.assertEqual([q[key] for q in quantities], [3, 5, 6])
+            self.assertEqual(Period.read_archived_cache(first,
+                    ('product', 'package'), [storage.id],
+                    grouping_filter=([product.id + 1],)), {})
+
+            # A grouping without archive is empty
+            shutil.rmtree(Period._archive_directory(first,
+                    Period.get_cache(('product',))))
+            self.assertEqual(Period.read_archived_cache(first,
+                    ('product',), [storage.id]), {})
+
+            moves = Move.search([('product', '=', product.id)])
+            with self.assertRaises(UserError):
+                Period.repair_caches(moves)
+
+            # The balances start from the archived cache once it is the
+            # latest closed period
+            Period.draft([second])
+            result = Product.get_package_balances([storage.id])
+            self.assertEqual(result['product'], [product.id])
+            self.assertEqual(result['number_of_packages'], [6])
+            self.assertIsNone(result['cursor'])
+
+            Period.draft([first])
+            first = Period(first.id)
+            self.assertFalse(first.caches_archived)
+            self.assertEqual(number_of_packages(), quantities)
+
+    @with_transaction()
+    def test_period_compact_caches(self):
+        'Test period caches without stock are not stored'
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        Period = pool.get('stock.period')
+        PeriodCache = pool.get('stock.period.cache.package')
+        Product = pool.get('product.product')
+        transaction = Transaction()
+
+        company = create_company()
+        with set_company(company):
+            (product, package), (other, other_package) = (
+                self.create_products(2))
+            supplier, = Location.search([('code', '=', 'SUP')])
+            storage, = Location.search([('code', '=', 'STO')])
+            customer, = Location.search([('code', '=', 'CUS')])
+            lost_found, = Location.search([('type', '=', 'lost_found')])
+            today = Date.today()
+            Move.do(self.create_moves(company, product, package,
+                    supplier, storage, today - datetime.timedelta(days=10),
+                    number_of_packages=2))
+            Move.do(self.create_moves(company, product, package,
+                    storage, customer, today - datetime.timedelta(days=9),
+                    number_of_packages=2))
+            Move.do(self.create_moves(company, other, other_package,
+                    supplier, storage, today - datetime.timedelta(days=10)))
+            period, = Period.create([{
+                        'date': today - datetime.timedelta(days=5),
+                        'company': company.id,
+                        }])
+            Period.close([period])
+
+            caches = PeriodCache.search([('period', '=', period.id)])
+            self.assertNotIn((storage, product),
+                {(c.location, c.product) for c in caches})
+            self.assertIn((storage, other),
+                {(c.location, c.product) for c in caches})
+
+            def number_of_packages():
+                Product.clear_number_of_packages_cache()
+                with transaction.set_context(stock_date_end=today,
+                        number_of_packages=True):
+                    return Product.products_by_location(
+                        [storage.id, lost_found.id],
+                        grouping=('product', 'package'))
+
+            quantities = number_of_packages()
+            cache = PeriodCache.__table__()
+            cursor = transaction.connection.cursor()
+            cursor.execute(*cache.insert(
+                    [cache.period, cache.location, cache.product,
+                        cache.package, cache.internal_quantity,
+                        cache.number_of_packages],
+                    [[period.id, lost_found.id, product.id, package.id,
+                            0, 0]]))
+
+            Period.compact_caches()
+            self.assertEqual(PeriodCache.search([
+                        ('period', '=', period.id),
+                        ('location', '=', lost_found.id),
+                        ('product', '=', product.id),
+                        ]), [])
+            self.assertEqual(number_of_packages(), quantities)
+
+    @with_transaction()
+    def test_period_repair_caches(self):
+        'Test repair period caches of backdated moves'
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        Period = pool.get('stock.period')
+        PeriodCache = pool.get('stock.period.cache.package')
+        transaction = Transaction()
+
+        company = create_company()
+        other_company = create_company(name='Other Company')
+        today = Date.today()
+        with set_company(other_company):
+            other_period, = Period.create([{
+                        'date': today - datetime.timedelta(days=5),
+                        'company': other_company.id,
+                        }])
+            Period.close([other_period])
+        with set_company(company):
+            product, package = self.create_product()
+            supplier, = Location.search([('code', '=', 'SUP')])
+            storage, = Location.search([('code', '=', 'STO')])
+            Move.do(self.create_moves(company, product, package,
+                    supplier, storage, today - datetime.timedelta(days=10),
+                    number_of_packages=2))
+            period, = Period.create([{
+                        'date': today - datetime.timedelta(days=5),
+                        'company': company.id,
+                        }])
+            Period.close([period])
+
+            moves = self.create_moves(company, product, package,
+                supplier, storage, today, number_of_packages=3)
+            Move.do(moves)
+            move_table = Move.__table__()
+            cursor = transaction.connection.cursor()
+            cursor.execute(*move_table.update(
+                    [move_table.effective_date],
+                    [today - datetime.timedelta(days=7)],
+                    where=move_table.id.in_([m.id for m in moves])))
+
+            def caches(period):
+                return {(c.location, c.product, c.package):
+                    (c.internal_quantity, c.number_of_packages)
+                    for c in PeriodCache.search([
+                            ('period', '=', period.id),
+                            ])}
+
+            Period.repair_caches(Move.browse([m.id for m in moves]))
+            repaired = caches(period)
+            self.assertEqual(repaired[(storage, product, package)],
+                (5 * package.qty, 5))
+            self.assertEqual(caches(other_period), {})
+
+            Period.draft([period])
+            Period.close([period])
+            self.assertEqual(caches(period), repaired)
+
+    @with_transaction()
+    def test_packages_by_date(self):
+        'Test number of packages by date'
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        Period = pool.get('stock.period')
+        Product = pool.get('product.product')
+
+        company = create_company()
+        with set_company(company):
+            product, package = self.create_product()
+            supplier, = Location.search([('code', '=', 'SUP')])
+            storage, = Location.search([('code', '=', 'STO')])
+            customer, = Location.search([('code', '=', 'CUS')])
+            today = Date.today()
+            days = [today - datetime.timedelta(days=d)
+                for d in range(10, -1, -1)]
+
+            Move.do(self.create_moves(company, product, package,
+                    supplier, storage, days[0], number_of_packages=5))
+            period, = Period.create([{
+                        'date': days[1],
+                        'company': company.id,
+                        }])
+            Period.close([period])
+            Move.do(self.create_moves(company, product, package,
+                    supplier, storage, days[3], number_of_packages=3))
+            Move.do(self.create_moves(company, product, package,
+                    storage, customer, days[6], number_of_packages=4))
+
+            result = Product.packages_by_date([storage.id], days[2:],
+                grouping=('product', 'package'))
+            for day in days[2:]:
+                with Transaction().set_context(stock_date_end=day,
+                        number_of_packages=True):
+                    pbl = Product.products_by_location([storage.id],
+                        grouping=('product', 'package'))
+                self.assertEqual(result[day],
+                    {k: int(v) for k, v in pbl.items() if v})
+
+    @with_transaction()
+    def test_move_validate_query_budget(self):
+        'Test Move.validate queries do not grow with moves'
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+
+        company = create_company()
+        with set_company(company):
+            product, package = self.create_product()
+            supplier, = Location.search([('code', '=', 'SUP')])
+            storage, = Location.search([('code', '=', 'STO')])
+
+            def prepare(count):
+                moves = self.create_moves(company, product, package,
+                    supplier, storage, Date.today(), count=count)
+                Move.do(moves)
+                return Move.browse([m.id for m in moves])
+
+            self.assertQueryBudget(prepare, Move.validate)
+
+    @with_transaction()
+    def test_inventory_line_create_query_budget(self):
+        'Test InventoryLine.create queries do not grow with lines'
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Inventory = pool.get('stock.inventory')
+        Line = pool.get('stock.inventory.line')
+        Location = pool.get('stock.location')
+
+        company = create_company()
+        with set_company(company):
+            storage, = Location.search([('code', '=', 'STO')])
+
+            def prepare(count):
+                inventory, = Inventory.create([{
+                            'location': storage.id,
+                            'date': Date.today(),
+                            'company': company.id,
+                            }])
+                return [{
+                        'inventory': inventory.id,
+                        'product': product.id,
+                        'package': package.id,
+                        'number_of_packages': 1,
+                        'quantity': package.qty,
+                        } for product, package in self.create_products(
+                        count)]
+
+            self.assertQueryBudget(prepare, Line.create)
+
+    @with_transaction()
+    def test_inventory_complete_lines_query_budget(self):
+        'Test Inventory.complete_lines queries do not grow with lines'
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Inventory = pool.get('stock.inventory')
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+
+        company = create_company()
+        with set_company(company):
+            supplier, = Location.search([('code', '=', 'SUP')])
+            storage, = Location.search([('code', '=', 'STO')])
+            today = Date.today()
+
+            def prepare(count):
+                products = self.create_products(count)
+                moves = []
+                for product, package in products:
+                    moves.extend(self.create_moves(company, product, package,
+                            supplier, storage,
+                            today - datetime.timedelta(days=1)))
+                Move.do(moves)
+                inventory, = Inventory.create([{
+                            'location': storage.id,
+                            'date': today,
+                            'company': company.id,
+                            'cycle_count': True,
+                            'lines': [('create', [{
+                                            'product': product.id,
+                                            'package': package.id,
+                                            'number_of_packages': 1,
+                                            'quantity': package.qty,
+                                            } for product, package in products
+                                        ])],
+                            }])
+                return Inventory.browse([inventory.id])
+
+            self.assertQueryBudget(prepare, Inventory.complete_lines)
+
+    @with_transaction()
+    def test_inventory_cycle_count(self):
+        'Test cycle count inventories only complete the scanned products'
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Inventory = pool.get('stock.inventory')
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+
+        company = create_company()
+        with set_company(company):
+            (product, package), (other, other_package) = (
+                self.create_products(2))
+            supplier, = Location.search([('code', '=', 'SUP')])
+            storage, = Location.search([('code', '=', 'STO')])
+            today = Date.today()
+            yesterday = today - datetime.timedelta(days=1)
+            Move.do(self.create_moves(company, product, package,
+                    supplier, storage, yesterday, number_of_packages=2))
+            Move.do(self.create_moves(company, other, other_package,
+                    supplier, storage, yesterday, number_of_packages=3))
+
+            inventory, = Inventory.create([{
+                        'location': storage.id,
+                        'date': today,
+                        'company': company.id,
+                        'cycle_count': True,
+                        'lines': [('create', [{
+                                        'product': product.id,
+                                        'package': package.id,
+                                        'number_of_packages': 1,
+                                        'quantity': package.qty,
+                                        }])],
+                        }])
+            line, = inventory.lines
+            # The expected number of packages is computed on creation
+            self.assertEqual(line.expected_number_of_packages, 2)
+
+            Inventory.complete_lines([inventory])
+            line, = Inventory(inventory.id).lines
+            self.assertEqual(line.product, product)
+            self.assertEqual(line.expected_number_of_packages, 2)
+            self.assertEqual(line.number_of_packages, 1)
+
+            Inventory.add_scanned_packages(inventory,
+                [(other.id, None, other_package.id, 1),
+                    (product.id, None, package.id, 2)])
+            lines = {l.product: l for l in Inventory(inventory.id).lines}
+            self.assertEqual(lines[product].number_of_packages, 3)
+            self.assertEqual(lines[product].quantity, 3 * package.qty)
+            self.assertEqual(lines[other].number_of_packages, 1)
+            self.assertEqual(lines[other].expected_number_of_packages, 3)
+
+            Inventory.cancel([inventory])
+            with self.assertRaises(UserError):
+                Inventory.add_scanned_packages(Inventory(inventory.id),
+                    [(other.id, None, other_package.id, 1)])
+
+    @with_transaction()
+    def test_inventory_import_package_counts(self):
+        'Test import package counts into inventory'
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Inventory = pool.get('stock.inventory')
+        Location = pool.get('stock.location')
+        Product = pool.get('product.product')
+        transaction = Transaction()
+
+        company = create_company()
+        with set_company(company):
+            (product, package), (other, other_package) = (
+                self.create_products(2))
+            Product.write([product], {'code': 'P1'}, [other], {'code': 'P2'})
+            storage, = Location.search([('code', '=', 'STO')])
+            inventory, = Inventory.create([{
+                        'location': storage.id,
+                        'date': Date.today(),
+                        'company': company.id,
+                        }])
+
+            # Whole batches of blank rows do not stop the import
+            with patch.object(transaction.database, 'IN_MAX', 2):
+                Inventory.import_package_counts(inventory,
+                    'P1,,,1\n\n\n,,,\nP2,,Package,2\nP1,,,1\n')
+            lines = {l.product: l for l in Inventory(inventory.id).lines}
+            self.assertEqual(lines[product].number_of_packages, 2)
+            self.assertEqual(lines[product].package, package)
+            self.assertEqual(lines[other].number_of_packages, 2)
+            self.assertEqual(lines[other].quantity, 2 * other_package.qty)
+
+            # Importing again replaces the counts of the existing lines
+            with patch.object(transaction.database, 'IN_MAX', 2):
+                Inventory.import_package_counts(inventory,
+                    iter(['P1,,,1\n', 'P2,,Package,3\n', 'P1,,,2\n']))
+            lines = {l.product: l for l in Inventory(inventory.id).lines}
+            self.assertEqual(lines[product].number_of_packages, 3)
+            self.assertEqual(lines[other].number_of_packages, 3)
+            self.assertEqual(lines[other].quantity, 3 * other_package.qty)
+
+            for data in ['P1,,1\n', 'P1,,,1,2\n', 'P1,,,one\n',
+                    'P3,,,1\n', 'P1,,Unknown,1\n']:
+                with self.assertRaises(UserError):
+                    Inventory.import_package_counts(inventory, data)
+
+    @with_transaction()
+    def test_inventory_confirm_query_budget(self):
+        'Test Inventory.confirm queries do not grow with lines'
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Inventory = pool.get('stock.inventory')
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+
+        company = create_company()
+        with set_company(company):
+            supplier, = Location.search([('code', '=', 'SUP')])
+            storage, = Location.search([('code', '=', 'STO')])
+            today = Date.today()
+
+            def prepare(count):
+                products = self.create_products(count)
+                moves = []
+                for product, package in products:
+                    moves.extend(self.create_moves(company, product, package,
+                            supplier, storage,
+                            today - datetime.timedelta(days=1)))
+                Move.do(moves)
+                inventory, = Inventory.create([{
+                            'location': storage.id,
+                            'date': today,
+                            'company': company.id,
+                            'lines': [('create', [{
+                                            'product': product.id,
+                                            'package': package.id,
+                                            'number_of_packages': 2,
+                                            'quantity': 2 * package.qty,
+                                            } for product, package in products
+                                        ])],
+                            }])
+                return Inventory.browse([inventory.id])
+
+            def execute(inventories):
+                Inventory.confirm(inventories)
+                for line in inventories[0].lines:
+                    move, = line.moves
+                    self.assertEqual(move.number_of_packages, 1)
+
+            self.assertQueryBudget(prepare, execute)
+
+    @with_transaction()
+    def test_inventory_confirm_check_packages(self):
+        'Test Inventory.confirm checks the packages of the lines'
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Inventory = pool.get('stock.inventory')
+        Location = pool.get('stock.location')
+
+        company = create_company()
+        with set_company(company):
+            (product, package), (other, other_package) = (
+                self.create_products(2))
+            storage, = Location.search([('code', '=', 'STO')])
+
+            inventory, = Inventory.create([{
+                        'location': storage.id,
+                        'date': Date.today(),
+                        'company': company.id,
+                        'lines': [('create', [{
+                                        'product': product.id,
+                                        'package': package.id,
+                                        'number_of_packages': 2,
+                                        'quantity': 2 * package.qty,
+                                        }, {
+                                        'product': other.id,
+                                        'package': other_package.id,
+                                        'number_of_packages': 2,
+                                        'quantity': 3 * other_package.qty,
+                                        }])],
+                        }])
+            with self.assertRaises(UserError):
+                Inventory.confirm([inventory])
+
+            line, = [l for l in inventory.lines if l.product == other]
+            line.quantity = 2 * other_package.qty
+            line.save()
+            Inventory.confirm([inventory])
+            inventory = Inventory(inventory.id)
+            self.assertEqual(inventory.state, 'done')
+            self.assertEqual(
+                sorted(m.number_of_packages for l in inventory.lines
+                    for m in l.moves),
+                [2, 2])
+
+    @with_transaction()
+    def test_template_number_of_packages_query_budget(self):
+        'Test template number of packages queries do not grow with templates'
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Template = pool.get('product.template')
+
+        company = create_company()
+        with set_company(company):
+            storage, = Location.search([('code', '=', 'STO')])
+
+            def prepare(count):
+                return [p.template.id for p, _ in self.create_products(count)]
+
+            def execute(template_ids):
+                with Transaction().set_context(locations=[storage.id]):
+                    Template.read(template_ids, ['number_of_packages'])
+
+            self.assertQueryBudget(prepare, execute)
+
+    @with_transaction()
+    def test_product_packagings_cache(self):
+        'Test product packagings cache is cleared on packaging changes'
+        pool = Pool()
+        Package = pool.get('product.pack')
+
+        (product, package), (other, _) = self.create_products(2)
+
+        def packagings():
+            return set(Package.get_product_packagings([product])[product.id])
+
+        self.assertEqual(packagings(), {package.id})
+        new_package, = Package.create([{
+                    'name': 'New Package',
+                    'product': product.template.id,
+                    'qty': 5,
+                    }])
+        self.assertEqual(packagings(), {package.id, new_package.id})
+        Package.write([new_package], {'product': other.template.id})
+        self.assertEqual(packagings(), {package.id})
+        Package.write([new_package], {'product': product.template.id})
+        self.assertEqual(packagings(), {package.id, new_package.id})
+        Package.delete([new_package])
+        self.assertEqual(packagings(), {package.id})
+
+    @with_transaction()
+    def test_package_quantities(self):
+        'Test conversion between quantities and packages of packagings'
+        pool = Pool()
+        Package = pool.get('product.pack')
+
+        product, package = self.create_product(qty=10)
+        small, = Package.create([{
+                    'name': 'Small Package',
+                    'product': product.template.id,
+                    'qty': 2.4,
+                    }])
+
+        self.assertEqual(Package.compute_quantities(
+                [product, product.id, product], [None] * 3,
+                [package, small.id, None], [3, 3, 3]),
+            [30.0, 7.0, None])
+        self.assertEqual(Package.compute_numbers_of_packages(
+                [product] * 4, [None] * 4, [package] * 3 + [None],
+                [30.0, 35.0, None, 30.0]),
+            [(3, True), (4, False), (None, False), (None, False)])
+        self.assertEqual(Package.check_numbers_of_packages(
+                [product] * 4, [None] * 4, [package] * 4,
+                [30.0, 35.0, 30.4, 30.0], [3, 3, 3, None]),
+            [True, False, True, False])
+
+    @with_transaction()
+    def test_check_no_move_query_budget(self):
+        'Test ProductPack.check_no_move queries do not grow with packagings'
+        pool = Pool()
+        Package = pool.get('product.pack')
+
+        def prepare(count):
+            return Package.browse(
+                [p.id for _, p in self.create_products(count)])
+
+        def execute(packages):
+            Package.check_no_move(packages,
+                'stock_number_of_packages.delete_packaging')
+
+        self.assertQueryBudget(prepare, execute)
+
+
+class StockNumberOfPackagesLotTestCase(PackagesTestMixin, unittest.TestCase):
+    'Test Stock Number of Packages module with lots'
+
+    @classmethod
+    def setUpClass(cls):
+        drop_db()
+        activate_module(['stock_number_of_packages', 'stock_lot'])
+
+    @classmethod
+    def tearDownClass(cls):
+        drop_db()
+
+    def create_lot(self, product, package, number='1', package_qty=None):
+        pool = Pool()
+        Lot = pool.get('stock.lot')
+        lot, = Lot.create([{
+                    'number': number,
+                    'product': product.id,
+                    'package': package.id,
+                    'package_qty': package_qty or package.qty,
+                    }])
+        return lot
+
+    @with_transaction()
+    def test_package_quantities_lot(self):
+        'Test conversion between quantities and packages of lots'
+        pool = Pool()
+        Lot = pool.get('stock.lot')
+        Package = pool.get('product.pack')
+
+        product, package = self.create_product(qty=10)
+        lot = self.create_lot(product, package, package_qty=4)
+
+        # The quantity by package of the lot is used before the packaging
+        self.assertEqual(Package.compute_quantities(
+                [product, product], [lot.id, None], [package, package],
+                [3, 3]),
+            [12.0, 30.0])
+        self.assertEqual(Package.compute_numbers_of_packages(
+                [product, product], [lot, None], [package, package],
+                [12.0, 12.0]),
+            [(3, True), (1, False)])
+        self.assertEqual(Package.check_numbers_of_packages(
+                [product, product], [lot, None], [package, package],
+                [12.0, 12.0], [3, 3]),
+            [True, False])
+
+        # Unsaved lots are not read
+        lot = Lot(product=product, package_qty=2.4,
+            initial_number_of_packages=3)
+        self.assertEqual(lot.on_change_with_total_qty(), 7.0)
+
+    @with_transaction()
+    def test_period_cache_lot_package(self):
+        'Test historical number of packages by lot and package'
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        Period = pool.get('stock.period')
+        Product = pool.get('product.product')
+        transaction = Transaction()
+
+        company = create_company()
+        with set_company(company):
+            product, package = self.create_product()
+            lots = [self.create_lot(product, package, number=str(i))
+                for i in range(2)]
+            supplier, = Location.search([('code', '=', 'SUP')])
+            storage, = Location.search([('code', '=', 'STO')])
+            today = Date.today()
+
+            closed_moves = []
+            for i, lot in enumerate(lots):
+                closed_moves.extend(self.create_moves(company, product,
+                        package, supplier, storage,
+                        today - datetime.timedelta(days=10),
+                        number_of_packages=i + 1, lot=lot))
+            Move.do(closed_moves)
+            period, = Period.create([{
+                        'date': today - datetime.timedelta(days=5),
+                        'company': company.id,
+                        }])
+            Period.close([period])
+            Move.do(self.create_moves(company, product, package,
+                    supplier, storage, today - datetime.timedelta(days=1),
+                    number_of_packages=3, lot=lots[0]))
+
+            period = Period(period.id)
+            self.assertEqual(
+                {(c.lot.id, c.package.id): c.number_of_packages
+                    for c in period.lot_package_caches
+                    if c.location == storage},
+                {
+                    (lots[0].id, package.id): 1,
+                    (lots[1].id, package.id): 2,
+                    })
+
+            def number_of_packages():
+                Product.clear_number_of_packages_cache()
+                with transaction.set_context(stock_date_end=today,
+                        number_of_packages=True):
+                    return Product.products_by_location([storage.id],
+                        grouping=('product', 'lot', 'package'),
+                        grouping_filter=([product.id],))
+
+            quantities = number_of_packages()
+            self.assertEqual(
+                quantities[(storage.id, product.id, lots[0].id, package.id)],
+                4)
+            self.assertEqual(
+                quantities[(storage.id, product.id, lots[1].id, package.id)],
+                2)
+
+            # The moves before the period must only be read from its cache
+            move = Move.__table__()
+            cursor = transaction.connection.cursor()
+            cursor.execute(*move.delete(
+                    where=move.id.in_([m.id for m in closed_moves])))
+            self.assertEqual(number_of_packages(), quantities)
+
+    @with_transaction()
+    def test_assign_try_packages(self):
+        'Test assign moves by whole packages of lots'
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+
+        company = create_company()
+        with set_company(company):
+            product, package = self.create_product()
+            old_lot = self.create_lot(product, package, number='1')
+            new_lot = self.create_lot(product, package, number='2')
+            supplier, = Location.search([('code', '=', 'SUP')])
+            storage, = Location.search([('code', '=', 'STO')])
+            customer, = Location.search([('code', '=', 'CUS')])
+            shelf, = Location.create([{
+                        'name': 'Shelf',
+                        'type': 'storage',
+                        'parent': storage.id,
+                        }])
+            today = Date.today()
+            Move.do(self.create_moves(company, product, package,
+                    supplier, shelf, today, number_of_packages=2,
+                    lot=old_lot))
+            Move.do(self.create_moves(company, product, package,
+                    supplier, storage, today, number_of_packages=3,
+                    lot=new_lot))
+
+            def assign(quantity, order):
+                previous = Move.search([('to_location', '=', customer.id)])
+                move, = Move.create([{
+                            'product': product.id,
+                            'uom': product.default_uom.id,
+                            'package': package.id,
+                            'quantity': quantity,
+                            'from_location': storage.id,
+                            'to_location': customer.id,
+                            'planned_date': today,
+                            'company': company.id,
+                            'unit_price': Decimal(1),
+                            'currency': company.currency.id,
+                            }])
+                success = Move.assign_try_packages([move], order=order)
+                moves = Move.search([
+                        ('to_location', '=', customer.id),
+                        ('id', 'not in', [m.id for m in previous]),
+                        ])
+                return success, {(m.from_location, m.lot, m.number_of_packages,
+                        m.quantity, m.state) for m in moves}
+
+            # The storage location is before its child
+            self.assertEqual(assign(20, 'location'), (True, {
+                        (storage, new_lot, 2, 20, 'assigned'),
+                        }))
+            # The oldest lot first then split and keep the remainder
+            self.assertEqual(assign(35, 'fifo'), (False, {
+                        (shelf, old_lot, 2, 20, 'assigned'),
+                        (storage, new_lot, 1, 10, 'assigned'),
+                        (storage, None, None, 5, 'draft'),
+                        }))
+
+            # Without childs only the from location of each move is used,
+            # even if the from location of another move is its child
+            Move.do(self.create_moves(company, product, package,
+                    supplier, shelf, today, number_of_packages=2,
+                    lot=old_lot))
+            moves = Move.create([{
+                        'product': product.id,
+                        'uom': product.default_uom.id,
+                        'package': package.id,
+                        'quantity': 10,
+                        'from_location': location.id,
+                        'to_location': customer.id,
+                        'planned_date': today,
+                        'company': company.id,
+                        'unit_price': Decimal(1),
+                        'currency': company.currency.id,
+                        } for location in (storage, shelf)])
+            self.assertFalse(
+                Move.assign_try_packages(moves, with_childs=False))
+            moves = Move.browse([m.id for m in moves])
+            self.assertEqual([(m.from_location, m.state) for m in moves],
+                [(storage, 'draft'), (shelf, 'assigned')])
+
+    @with_transaction()
+    def test_shipment_packages_weight(self):
+        'Test packages weight of supplier shipments'
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Location = pool.get('stock.location')
+        Lot = pool.get('stock.lot')
+        Move = pool.get('stock.move')
+        Package = pool.get('product.pack')
+        Party = pool.get('party.party')
+        ShipmentIn = pool.get('stock.shipment.in')
+
+        company = create_company()
+        with set_company(company):
+            product, package = self.create_product()
+            Package.write([package], {
+                    'weight': 0.5,
+                    'pallet_weight': 10,
+                    'layers': 2,
+                    'packages_layer': 2,
+                    })
+            lot = self.create_lot(product, package)
+            Lot.write([lot], {
+                    'initial_number_of_packages': 4,
+                    'weight_by_package': 9,
+                    'package_weight': 1,
+                    'pallet_weight': 20,
+                    })
+            supplier, = Location.search([('code', '=', 'SUP')])
+            warehouse, = Location.search([('code', '=', 'WH')])
+            party, = Party.create([{'name': 'Supplier'}])
+            shipment, = ShipmentIn.create([{
+                        'supplier': party.id,
+                        'warehouse': warehouse.id,
+                        'company': company.id,
+                        }])
+            today = Date.today()
+            moves = self.create_moves(company, product, package, supplier,
+                warehouse.input_location, today, number_of_packages=2,
+                lot=lot)
+            moves += self.create_moves(company, product, package, supplier,
+                warehouse.input_location, today, number_of_packages=4)
+            Move.write(moves, {'shipment': str(shipment)})
+
+            shipment = ShipmentIn(shipment.id)
+            # Half the pallet of the lot and a whole pallet of packaging
+            self.assertEqual(shipment.packages_weight, 18)
+            self.assertEqual(shipment.packages_gross_weight,
+                2 * (9 + 1) + 10 + 4 * 0.5 + 10)
+
+    @with_transaction()
+    def test_receive_pallets(self):
+        'Test receive pallets on supplier shipments'
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Package = pool.get('product.pack')
+        Party = pool.get('party.party')
+        ShipmentIn = pool.get('stock.shipment.in')
+
+        company = create_company()
+        with set_company(company):
+            product, package = self.create_product()
+            Package.write([package], {
+                    'weight': 0.5,
+                    'pallet_weight': 10,
+                    'layers': 2,
+                    'packages_layer': 3,
+                    })
+            warehouse, = Location.search([('code', '=', 'WH')])
+            party, = Party.create([{'name': 'Supplier'}])
+            shipment, = ShipmentIn.create([{
+                        'supplier': party.id,
+                        'warehouse': warehouse.id,
+                        'company': company.id,
+                        }])
+
+            moves = ShipmentIn.receive_pallets(shipment, [{
+                        'product': product.id,
+                        'number': 'P1',
+                        }, {
+                        'product': product.id,
+                        'number': 'P2',
+                        'number_of_packages': 4,
+                        }])
+            moves.sort(key=lambda m: m.lot.number)
+            self.assertEqual([(m.quantity, m.number_of_packages, m.package)
+                    for m in moves],
+                [(60, 6, package), (40, 4, package)])
+            self.assertEqual([m.shipment for m in moves], [shipment] * 2)
+            self.assertEqual([m.to_location for m in moves],
+                [warehouse.input_location] * 2)
+            for move, number in zip(moves, [6, 4]):
+                lot = move.lot
+                self.assertEqual(lot.package, package)
+                self.assertEqual(lot.package_qty, 10)
+                self.assertEqual(lot.package_weight, 0.5)
+                self.assertEqual(lot.pallet_weight, 10)
+                self.assertEqual(lot.initial_number_of_packages, number)
+                self.assertEqual(lot.total_qty, number * 10)
+
+            ShipmentIn.cancel([shipment])
+            with self.assertRaises(UserError):
+                ShipmentIn.receive_pallets(shipment, [{
+                            'product': product.id,
+                            'number': 'P3',
+                            }])
+
+
+class StockNumberOfPackagesParallelTestCase(PackagesTestMixin,
+        unittest.TestCase):
+    'Test Stock Number of Packages module with concurrent transactions'
+
+    @classmethod
+    def setUpClass(cls):
+        if DB_NAME == ':memory:':
+            raise unittest.SkipTest('The database in memory is not shared')
+        drop_db()
+        activate_module('stock_number_of_packages')
+        # The stock is committed to be seen by the other connections, the
+        # database is dropped with it
+        with Transaction().start(DB_NAME, 1):
+            company = create_company()
+            with set_company(company):
+                locations, products = cls.create_parallel_stock(company)
+            cls.location_ids = [l.id for l in locations]
+            cls.product_ids = [p.id for p in products]
+
+    @classmethod
+    def tearDownClass(cls):
+        drop_db()
+
+    def test_products_by_location_parallel(self):
+        'Test parallel number of packages match sequential computation'
+        with Transaction().start(DB_NAME, 1, readonly=True):
+            pool = Pool()
+            Location = pool.get('stock.location')
+            Product = pool.get('product.product')
+            User = pool.get('res.user')
+            with Transaction().set_context(
+                    User.get_preferences(context_only=True)):
+                sequential, parallel = self.products_by_location_parallel(
+                    Location.browse(self.location_ids),
+                    Product.browse(self.product_ids))
+        self.assertEqual(parallel, sequential)
+        self.assertEqual(len(parallel), 4)
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()
     suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
             StockNumberOfPackagesTestCase))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
+            StockNumberOfPackagesLotTestCase))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
+            StockNumberOfPackagesParallelTestCase))
     # suite.addTests(doctest.DocFileSuite(
     #         'scenario_stock_number_of_packages.rst',
     #         setUp=doctest_setup, tearDown=doctest_teardown, encoding='utf-8',